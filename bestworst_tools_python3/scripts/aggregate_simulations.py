@@ -61,7 +61,8 @@ def main(argv = sys.argv[1:]):
         
         # read in the data for each file and save it
         for file in files:
-            ss = Spreadsheet.read_csv(file)
+            # only the numeric score columns are ever converted, each once
+            ss = Spreadsheet.read_csv(file, columnar=True)
 
             # the column name for the latent dimension, always 2nd column.
             # first column is Item name.
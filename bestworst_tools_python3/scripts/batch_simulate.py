@@ -38,7 +38,8 @@ def main(argv=sys.argv[1:]):
     parser.add_argument("--K", type=int, default=4, help="K sizes to try.")
     parser.add_argument("--sep", type=str, default=None, help="Column seperator for the input file")
     parser.add_argument("--dummy", type=bool, default=True, help="use a dummy player to bound tournament-based scores.")
-    parser.add_argument("--iters", type=int, default=100, help="Number of iterations to run tournament-based methods for. 100 is likely sufficient to ensure convergence, if not a little overkill.")
+    parser.add_argument("--max-iters", "--iters", dest="iters", type=int, default=100, help="Maximum number of iterations to run tournament-based methods for. 100 is likely sufficient to ensure convergence, if not a little overkill; see --tol.")
+    parser.add_argument("--tol", type=float, default=None, help="If specified, tournament-based methods stop early once an iteration changes none of their scores by more than this fraction of their range (e.g., 0.001).")
     parser.add_argument("--item", type=str, default="Item", help="Column corresponding to item name.")
     parser.add_argument("--latentvalue", type=str, default="LatentValue", help="Column corresponding to latent value name.")
     parser.add_argument("--num_simulations", type=int, default=100, help="Number of simulations per parameter set to run.")
@@ -72,8 +73,10 @@ def main(argv=sys.argv[1:]):
                     path = os.path.join(args.dir, fname)
 
                     # prepare the command
-                    cmd = "python3 scripts/simulate_results.py %s %d %d --noise=%f --generator=%s --item=%s --latentvalue=%s --dummy=%s --iters=%s" % \
+                    cmd = "python3 scripts/simulate_results.py %s %d %d --noise=%f --generator=%s --item=%s --latentvalue=%s --dummy=%s --max-iters=%s" % \
                           (args.input, N, args.K, noise, generator, args.item, args.latentvalue, str(args.dummy), args.iters)
+                    if args.tol is not None:
+                        cmd += " --tol=%s" % str(args.tol)
                     
                     # run the simulation
                     os.system("%s > %s" % (cmd, path))
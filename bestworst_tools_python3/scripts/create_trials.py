@@ -4,7 +4,8 @@ create_trials.py
 Takes a plaintext file (.txt, .csv, or .tsv, sorry no .xls!) containing a list
 of words and, from those words, generates a series of best-worst trials. The
 input file may either be a list of words separated by whitespace (.txt), or
-some sort of structured text file where a column name of specified.
+some sort of structured text file where a column name of specified. Any of
+these may also be compressed (e.g., words.txt.gz).
 
 Script provides options for customizing how best-worst trials are generated.
 Default options are the suggested options. Don't screw around unless you know
@@ -28,8 +29,9 @@ Parastoo Harati
 p.harati@ualberta.ca
 December 15, 2023
 """
-import sys, argparse, trialgen
-from spreadsheet import Spreadsheet
+import sys, argparse, trialgen, scoring, trialstore
+import numpy as np
+from spreadsheet import Spreadsheet, open_text, infer_sep, strip_compression
 
 
 
@@ -38,25 +40,33 @@ def main(argv=sys.argv[1:]):
     parser.add_argument("input", type=str, help="Path to a file containing input data (i.e., a list of words or other text stimuli).")
     parser.add_argument("N", nargs="?", type=int, default=None, help="Number of best-worst trials to generate. Suggested amount: number of items, times 8. So if you have 1000 items, 8000 trials. You may get *slightly* better results up to an N of 16, but gains are marginal. You may need fewer trials if your K is larger. Empirical testing not yet done.")
     parser.add_argument("K", nargs="?", type=int, default=4, help="Number of items per best-worst trial.")
-    parser.add_argument("--generator", type=str, default="norepeateven", help="Method for generating trials. Don't screw with unless you know what you are doing. Options are: random, even, norepeat, norepeateven.") 
+    parser.add_argument("--generator", type=str, default="norepeateven", help="Method for generating trials. Don't screw with unless you know what you are doing. Options are: random, even, norepeat, norepeateven, bibd, adaptive. bibd constructs a balanced design with no repeated pairs outright where one exists, and otherwise falls back on norepeateven. adaptive builds the next trials for an experiment under way, from the --results collected so far.") 
     parser.add_argument("--column", type=str, default=None, help="If inputting a structured text file, indicate which column to pull data from.")
-    parser.add_argument("--sep", type=str, default=None, help="Specify the column separator. If None specified, use default (tab for .tsv, comma for all else)")
+    parser.add_argument("--sep", type=str, default=None, help="Specify the column separator. If None specified, use default (tab for .tsv, also when compressed as .tsv.gz etc., comma for all else)")
+    parser.add_argument("--time_limit", type=float, default=trialgen.NOREPEAT_TIME_LIMIT, help="For the norepeat generator: stop after this many seconds, with the trials built so far. Defaults to %d." % trialgen.NOREPEAT_TIME_LIMIT)
+    parser.add_argument("--max_attempts", type=int, default=None, help="For the norepeat generator: stop after abandoning this many partly built trials, with the trials built so far. It always stops after abandoning %d in a row." % trialgen.NOREPEAT_STREAK)
+    parser.add_argument("--progress", action="store_true", help="For the norepeat generator: report progress on stderr.")
+    parser.add_argument("--results", type=str, nargs="+", default=None, help="For the adaptive generator: the best-worst data collected so far (CSV/TSV files or trial stores), as read by score_trials.py. Trials are concentrated on items whose scores are still uncertain, and the items scored close to them.")
+    parser.add_argument("--method", type=str, default="MaxDiffMNL", help="For the adaptive generator: the scoring method to rank items by. MaxDiffMNL (the default) supplies its own standard errors; for other methods, they are approximated from how often each item has been seen.")
+    parser.add_argument("--best", type=str, default="best", help="For the adaptive generator: name of the column in --results that holds the 'best' choice.")
+    parser.add_argument("--worst", type=str, default="worst", help="For the adaptive generator: name of the column in --results that holds the 'worst' choice.")
+    parser.add_argument("--max_exposure", type=int, default=None, help="For the adaptive generator: the most times any one item may appear in the new trials. Defaults to %g times its share of an even design." % trialgen.ADAPTIVE_SLACK)
+    parser.add_argument("--exclude", type=str, default=None, help="A file of items that must never appear in the same trial together (e.g., variants of one word): one group per line, items separated by commas (tabs for .tsv). Honoured by every generator.")
+    parser.add_argument("--evaluate", action="store_true", help="After generating trials, report the design's balance, pair repeats, and connectivity on stderr (see trialgen.py evaluate).")
 
     args = parser.parse_args()
     
     # read in the items to build trials from
     items = [ ]
-    if args.input.endswith(".txt") and args.sep == None and args.column == None:
-        items = [item.strip() for item in open(args.input, "r").read().split() ]
+    if strip_compression(args.input).endswith(".txt") and args.sep == None and args.column == None:
+        items = [item.strip() for item in open_text(args.input).read().split() ]
     elif args.column == None:
         raise Exception("You must specify a column name with --column= to generate trials this way.")
     else:
         # comma by default or if specified, tab if .tsv
         sep = args.sep
-        if sep == None and args.input.endswith(".tsv"):
-            sep = "\t"
-        elif sep == None:
-            sep = ","
+        if sep == None:
+            sep = infer_sep(args.input)
         ss = Spreadsheet.read_csv(args.input, delimiter=sep)
 
         # take the first column if no column specified
@@ -71,24 +81,69 @@ def main(argv=sys.argv[1:]):
     if N == None:
         N = len(items) * 8
         
-    # generate trials from items
-    trials = [ ]
+    # read in the groups of items that may not appear together
+    exclude = None
+    if args.exclude != None:
+        exclude, unknown = trialgen.read_exclusions(args.exclude, items)
+        if len(unknown) > 0:
+            sys.stderr.write("Ignoring %d items in %s that are not in %s.\n" % (len(unknown), args.exclude, args.input))
+
+    # set up generation of trials from items, one batch at a time
+    stats    = { }
+    progress = None
     if args.generator == "norepeateven":
-        trials = trialgen.build_trials_even_bigram_norepeat(items, N=N, K=K)
+        batches = trialgen.iter_index_even_bigram_norepeat(len(items), N=N, K=K, stats=stats, exclude=exclude)
+    elif args.generator == "bibd":
+        batches = trialgen.iter_index_bibd(len(items), N=N, K=K, stats=stats, exclude=exclude)
     elif args.generator == 'even':
-        trials = trialgen.build_trials_even(items, N=N, K=K)
+        batches = trialgen.iter_index_even(len(items), N=N, K=K, exclude=exclude)
     elif args.generator == 'random':
-        trials = trialgen.build_trials_random(items, N=N, K=K)
+        batches = trialgen.iter_index_random(len(items), N=N, K=K, exclude=exclude)
     elif args.generator == "norepeat":
-        trials = trialgen.build_trials_random_bigram_norepeat(items, N=N, K=K)
+        if args.progress == True:
+            progress = lambda built, N, abandoned: sys.stderr.write("%d of %d trials (%d abandoned)\n" % (built, N, abandoned))
+        batches = trialgen.iter_index_random_bigram_norepeat(len(items), N=N, K=K, max_attempts=args.max_attempts,
+                                                            time_limit=args.time_limit, progress=progress,
+                                                            stats=stats, exclude=exclude)
+    elif args.generator == "adaptive":
+        if args.results == None:
+            raise Exception("The adaptive generator needs the data collected so far, given with --results.")
+        # Best is scored too, so that trial counts are always tallied
+        table  = scoring.score_encoded(trialstore.load_encoded(args.results, bestCol=args.best, worstCol=args.worst),
+                                       [ args.method, "Best" ])
+        scores, uncertainty = scoring.score_uncertainty(table, args.method)
+
+        # items that have not been seen yet are left unscored; labels are
+        # matched as text, as results may read numeric labels as numbers
+        labels = { str(entity) : i for i, entity in enumerate(table.entities) }
+        known  = np.array([ labels.get(str(item), -1) for item in items ], dtype=np.int64)
+        scores = np.where(known >= 0, scores[known], np.nan)
+        uncertainty = np.where(known >= 0, uncertainty[known], np.inf)
+        batches = trialgen.iter_index_adaptive(scores, uncertainty, N=N, K=K, max_exposure=args.max_exposure,
+                                               stats=stats, exclude=exclude)
     else:
-        raise Exception("You must specify a proper generation method: norepeateven, even, random, norepeat.")
+        raise Exception("You must specify a proper generation method: norepeateven, even, random, norepeat, bibd, adaptive.")
+
+    # tally each batch as it goes past if the design is to be evaluated, so
+    # the design is still never held in memory
+    tally = trialgen.DesignTally(len(items), K)
+    if args.evaluate == True:
+        batches = tally.track(batches)
 
-    # print the output, complete with header.
-    header = [ "option%d" % (i+1) for i in range(K) ]
-    print(",".join(header))
-    for trial in trials:
-        print(",".join(trial))
+    # print the output, complete with header, as each batch is generated
+    written = trialgen.write_trials(sys.stdout, items, batches, K)
+    if stats.get("repeats", 0) > 0:
+        sys.stderr.write("Could not avoid %d repeated pairs of items.\n" % stats["repeats"])
+    if stats.get("complete", True) == False and args.generator == "adaptive":
+        sys.stderr.write("Only built %d of %d trials before too few items were left under --max_exposure.\n" % (written, N))
+    elif stats.get("complete", True) == False:
+        sys.stderr.write("Only built %d of %d trials without repeating pairs, before reaching the time or attempt limit, or abandoning %d partly built trials in a row.\n" % (written, N, trialgen.NOREPEAT_STREAK))
+    if stats.get("construction", None) == "greedy":
+        sys.stderr.write("No cyclic design fits %d items in %d trials of size %d%s; used norepeateven instead.\n" % (len(items), N, K, "" if exclude == None else ", with the exclusions"))
+    elif stats.get("construction", None) == "padded":
+        sys.stderr.write("No cyclic design fits %d items; built one over %d items and dropped the trials of the %d dummy items.\n" % (len(items), len(items) + stats["dummies"], stats["dummies"]))
+    if args.evaluate == True:
+        trialgen.print_evaluation(tally.evaluate(), out=sys.stderr)
         
 if __name__ == "__main__":
     sys.exit(main())
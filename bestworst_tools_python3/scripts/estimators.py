@@ -0,0 +1,325 @@
+"""
+estimators.py
+
+Direct estimators of item strength from best-worst data. Unlike the tournament
+learners in tournament.py (Elo, Value, Rescorla-Wagner), which approximate a
+score through many shuffled passes over the pairings, these fit a statistical
+model of the choices outright, and give the same answer regardless of pairing
+order.
+
+Items are identified by integer index, as produced by scoring.encode_trials.
+Pairings are given as parallel arrays of winner and loser indices, as produced
+by scoring.compile_encoded_pairings, and trials as a padded option matrix, as
+produced by scoring.encode_trial_matrix.
+
+This software is released under the Creative Commons licence:
+  Attribution-NonCommerical-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+  https://creativecommons.org/licenses/by-nc-sa/4.0/
+
+For published academic research using these tools, please cite:
+  Hollis, G. (2017). Scoring best/worst data in unbalanced, many-item designs,
+    with applications to crowdsourcing semantic judgments. Behavior Research
+    Methods, XX(X), 1-19. doi: 10.3758/s13428-017-0898-2
+"""
+import numpy as np
+
+
+
+################################################################################
+# VARIABLES
+################################################################################
+
+# log strengths are kept within +/- this bound, for items that never won or
+# never lost when no dummies are used
+LOG_BOUND = 50.0
+
+# the most conjugate gradient iterations spent on any one MaxDiff Newton step
+MNL_CG_ITERS = 100
+
+# without dummies, the ridge penalty that keeps MaxDiff utilities finite for
+# items that were always (or never) chosen best
+MNL_RIDGE = 1e-4
+
+
+
+################################################################################
+# SUPPORT FUNCTIONS
+################################################################################
+def add_dummy_pairings(winners, losers, n_items, counts=None):
+    """Adds an always-win dummy (index n_items) that beats every item once, and
+       an always-lose dummy (index n_items+1) that loses to every item once.
+       Returns the extended winner and loser arrays, and, if the pairings are
+       weighted by counts, the extended counts as well.
+    """
+    ids     = np.arange(n_items, dtype=np.int32)
+    winners = np.concatenate((winners, np.full(n_items, n_items,   dtype=np.int32), ids))
+    losers  = np.concatenate((losers,  ids, np.full(n_items, n_items+1, dtype=np.int32)))
+    if counts is None:
+        return winners, losers
+    counts  = np.concatenate((counts, np.ones(2 * n_items, dtype=np.asarray(counts).dtype)))
+    return winners, losers, counts
+
+def count_edges(winners, losers, n_items, counts=None):
+    """Collapses pairings into unique directed (winner, loser) edges. Returns
+       parallel arrays of edge winners, edge losers, and how many times each
+       edge occurred. If the pairings are already weighted by counts, those
+       counts are summed instead.
+    """
+    keys = np.asarray(winners, dtype=np.int64) * n_items + np.asarray(losers, dtype=np.int64)
+    if counts is None:
+        keys, counts = np.unique(keys, return_counts=True)
+    else:
+        keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, weights=counts, minlength=len(keys))
+    return keys // n_items, keys % n_items, counts.astype(np.float64)
+
+
+
+################################################################################
+# ESTIMATORS
+################################################################################
+def fit_bradley_terry(winners, losers, n_items, dummy=True, tol=1e-4, max_iters=1000, counts=None):
+    """Fits a Bradley-Terry model, P(i beats j) = p[i] / (p[i] + p[j]), to the
+       pairings given by winners and losers. Strengths are found by the
+       fixed-point iteration of Newman (2023), a reformulation of the
+       minorization-maximization algorithm of Hunter (2004) that converges to
+       the same maximum likelihood estimate in far fewer passes:
+
+         p[i] <- sum_j( w[i,j] p[j] / (p[i] + p[j]) ) / sum_j( w[j,i] / (p[i] + p[j]) )
+
+       where w[i,j] is the number of times i beat j. Each pass is a pair of
+       weighted bincounts over the unique (winner, loser) edges, not over
+       every pairing. Pairings may also be given already collapsed into
+       edges, with counts holding the multiplicity of each.
+
+       If dummy is True, an always-win and an always-lose dummy are added, with
+       one pairing against each item, as for the tournament methods. Both are
+       held at a fixed strength of 1, so each item gains one win and one loss
+       against an average opponent. These pseudo-comparisons keep strengths
+       finite for items that never won or never lost. Without them, such items
+       have no finite estimate, and are reported at a log strength of
+       +/-LOG_BOUND.
+
+       Iteration stops once no log strength changes by more than tol, or after
+       max_iters passes. Returns one strength per item, scaled so that their
+       geometric mean is 1; an item of strength p beats an average item with
+       probability p / (1 + p).
+    """
+    winners = np.asarray(winners, dtype=np.int32)
+    losers  = np.asarray(losers,  dtype=np.int32)
+    if n_items == 0:
+        return np.zeros(0)
+    n_total = n_items
+    if counts is None:
+        counts = np.ones(len(winners))
+    if dummy == True:
+        winners, losers, counts = add_dummy_pairings(winners, losers, n_items, counts)
+        n_total = n_items + 2
+    edge_w, edge_l, counts = count_edges(winners, losers, n_total, counts)
+
+    log_p = np.zeros(n_total)
+    for i in range(max_iters):
+        p     = np.exp(log_p)
+        rate  = counts / (p[edge_w] + p[edge_l])
+        num   = np.bincount(edge_w, weights=rate * p[edge_l], minlength=n_total)
+        denom = np.bincount(edge_l, weights=rate, minlength=n_total)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            new_log_p = np.nan_to_num(np.log(num) - np.log(denom), nan=0.0)
+        new_log_p = np.clip(new_log_p, -LOG_BOUND, LOG_BOUND)
+
+        # strengths are only identified up to scale: either the dummies fix
+        # it, or we fix the geometric mean
+        if dummy == True:
+            new_log_p[n_items:] = 0.0
+        else:
+            new_log_p -= new_log_p.mean()
+        delta = np.abs(new_log_p - log_p).max()
+        log_p = new_log_p
+        if delta <= tol:
+            break
+
+    log_p = log_p[:n_items]
+    return np.exp(log_p - log_p.mean())
+
+def fit_rank_centrality(winners, losers, n_items, dummy=True, tol=1e-8, max_iters=10000, counts=None):
+    """Scores items by rank centrality (Negahban, Oh, & Shah, 2017): the
+       stationary distribution of a random walk over the comparison graph
+       that, from each item, moves to the opponents that beat it. Steps are
+       weighted by comparison counts, as in Agarwal, Patil, & Agarwal (2018):
+       each step moves from item i to opponent j with probability
+       w[j,i] / d[i], where w[j,i] is the number of times j beat i and d[i] is
+       the number of comparisons i took part in; otherwise, the walk stays
+       put. The stationary distribution, divided by d, is then proportional
+       to Bradley-Terry strength.
+
+       The distribution is found by power iteration from uniform, with each
+       step a weighted bincount over the unique (winner, loser) edges; as for
+       fit_bradley_terry, pairings may be given already collapsed into edges,
+       with counts holding the multiplicity of each. Iteration stops once the
+       distribution changes by no more than tol in total (L1), or after
+       max_iters steps.
+
+       If dummy is True, one virtual item is added, with one win and one loss
+       against every item, which plays the part of the always-win and
+       always-lose dummies: it keeps the walk from being trapped among items
+       that never lost. Without it, items that never won are reported at a
+       log strength of -LOG_BOUND.
+
+       Returns one strength per item, scaled so that their geometric mean is
+       1, as for fit_bradley_terry (items at -LOG_BOUND aside).
+    """
+    if n_items == 0:
+        return np.zeros(0)
+    n_total = n_items + int(dummy == True)
+    edge_w, edge_l, counts = count_edges(winners, losers, n_total, counts)
+    if dummy == True:
+        ids     = np.arange(n_items, dtype=np.int64)
+        virtual = np.full(n_items, n_items, dtype=np.int64)
+        edge_w  = np.concatenate((edge_w, virtual, ids))
+        edge_l  = np.concatenate((edge_l, ids, virtual))
+        counts  = np.concatenate((counts, np.ones(2 * n_items)))
+
+    # the number of comparisons each item took part in
+    degree = np.bincount(edge_w, weights=counts, minlength=n_total) + \
+             np.bincount(edge_l, weights=counts, minlength=n_total)
+
+    # every edge moves mass from its loser to its winner
+    rate  = counts / degree[edge_l]
+    leave = np.bincount(edge_l, weights=rate, minlength=n_total)
+    dist  = np.full(n_total, 1.0 / n_total)
+    for i in range(max_iters):
+        new_dist = dist - dist * leave + np.bincount(edge_w, weights=dist[edge_l] * rate, minlength=n_total)
+        delta    = np.abs(new_dist - dist).sum()
+        dist     = new_dist
+        if delta <= tol:
+            break
+
+    with np.errstate(divide="ignore"):
+        log_p = np.log(dist[:n_items] / degree[:n_items])
+    finite = np.isfinite(log_p)
+    if finite.any():
+        log_p = log_p - log_p[finite].mean()
+    log_p = np.where(finite, log_p, -LOG_BOUND)
+    return np.exp(np.clip(log_p, -LOG_BOUND, LOG_BOUND))
+
+def fit_maxdiff_mnl(options, n_items, dummy=True, tol=1e-6, max_iters=50):
+    """Fits the sequential best-worst multinomial logit (MaxDiff) model
+       directly to trials, rather than to pairings. Each trial offers a set
+       of items S; the best item b is chosen with probability
+       exp(u[b]) / sum_S exp(u[j]), and then the worst item w is chosen from
+       the rest with probability exp(-u[w]) / sum_S-b exp(-u[j]).
+
+       options is an (n_trials, K) integer matrix of item indices, with the
+       best item in column 0, the worst in column 1, and the others after;
+       trials with fewer than K items are padded with -1. Utilities are found
+       by truncated Newton steps: each step solves the Newton system with
+       conjugate gradients, preconditioned by the Hessian diagonal, using
+       Hessian-vector products computed over the whole option matrix at once.
+
+       If dummy is True, each item gains one win and one loss against an
+       average item (as the dummies do for fit_bradley_terry), which keeps
+       utilities finite. Otherwise, a very weak ridge penalty (MNL_RIDGE) is
+       used instead, and utilities are centered on zero.
+
+       Iteration stops once no utility changes by more than tol, or after
+       max_iters Newton steps. Returns a tuple of (utilities, standard
+       errors), one per item; standard errors are taken from the diagonal of
+       the Hessian at the fitted utilities.
+    """
+    options = np.asarray(options, dtype=np.int64)
+    if n_items == 0 or len(options) == 0:
+        return np.zeros(n_items), np.zeros(n_items)
+    valid       = options >= 0
+    worst_valid = valid.copy()
+    worst_valid[:,0] = False
+    index       = np.where(valid, options, 0)
+    flat        = index.ravel()
+
+    # each trial's best item is chosen once, and its worst item rejected once
+    chosen = np.bincount(options[:,0], minlength=n_items) - \
+             np.bincount(options[:,1], minlength=n_items).astype(np.float64)
+
+    def evaluate(u):
+        """Returns the log likelihood of u, and the best and worst choice
+           probabilities of every option.
+        """
+        U    = u[index]
+        best = np.where(valid, U, -np.inf)
+        best = np.exp(best - best.max(axis=1, keepdims=True))
+        best_total = best.sum(axis=1)
+        worst = np.where(worst_valid, -U, -np.inf)
+        worst = np.exp(worst - worst.max(axis=1, keepdims=True))
+        worst_total = worst.sum(axis=1)
+        ll = np.log(best[:,0] / best_total).sum() + np.log(worst[:,1] / worst_total).sum()
+        if dummy == True:
+            ll -= (np.logaddexp(0.0, -u) + np.logaddexp(0.0, u)).sum()
+        else:
+            ll -= 0.5 * MNL_RIDGE * u.dot(u)
+        return ll, best / best_total[:,None], worst / worst_total[:,None]
+
+    def prior_curvature(u):
+        """Returns the gradient and curvature of the dummy or ridge terms.
+        """
+        if dummy == True:
+            s = 1.0 / (1.0 + np.exp(-u))
+            return 1.0 - 2.0 * s, 2.0 * s * (1.0 - s)
+        return -MNL_RIDGE * u, np.full(n_items, MNL_RIDGE)
+
+    def hessian_diagonal(P, Q, curvature):
+        return np.bincount(flat, weights=(P * (1.0 - P) + Q * (1.0 - Q)).ravel(),
+                           minlength=n_items) + curvature
+
+    def hessian_product(v, P, Q, curvature):
+        V = v[index]
+        r = P * (V - (P * V).sum(axis=1, keepdims=True)) + \
+            Q * (V - (Q * V).sum(axis=1, keepdims=True))
+        return np.bincount(flat, weights=r.ravel(), minlength=n_items) + curvature * v
+
+    u = np.zeros(n_items)
+    ll, P, Q = evaluate(u)
+    for i in range(max_iters):
+        prior_grad, curvature = prior_curvature(u)
+        grad = chosen - np.bincount(flat, weights=(P - Q).ravel(), minlength=n_items) + prior_grad
+        diag = hessian_diagonal(P, Q, curvature)
+
+        # solve for the Newton step with preconditioned conjugate gradients,
+        # only as accurately as the current gradient warrants
+        step   = np.zeros(n_items)
+        resid  = grad.copy()
+        z      = resid / diag
+        direct = z.copy()
+        rz     = resid.dot(z)
+        norm   = np.sqrt(grad.dot(grad))
+        target = min(0.5, np.sqrt(norm)) * norm
+        for k in range(MNL_CG_ITERS):
+            Hd    = hessian_product(direct, P, Q, curvature)
+            dHd   = direct.dot(Hd)
+            if dHd <= 0:
+                break
+            alpha  = rz / dHd
+            step  += alpha * direct
+            resid -= alpha * Hd
+            if np.sqrt(resid.dot(resid)) <= target:
+                break
+            z      = resid / diag
+            rz_new = resid.dot(z)
+            direct = z + (rz_new / rz) * direct
+            rz     = rz_new
+
+        # backtrack until the step improves the likelihood
+        scale = 1.0
+        while True:
+            new_u = np.clip(u + scale * step, -LOG_BOUND, LOG_BOUND)
+            new_ll, new_P, new_Q = evaluate(new_u)
+            if new_ll >= ll or scale < 1e-4:
+                break
+            scale *= 0.5
+        delta = np.abs(new_u - u).max()
+        u, ll, P, Q = new_u, new_ll, new_P, new_Q
+        if delta <= tol:
+            break
+
+    if dummy != True:
+        u = u - u.mean()
+    diag = hessian_diagonal(P, Q, prior_curvature(u)[1])
+    return u, 1.0 / np.sqrt(diag)
@@ -26,7 +26,7 @@ Parastoo Harati
 p.harati@ualberta.ca
 December 15, 2023
 """
-import sys, argparse, scoring
+import sys, argparse, scoring, trialstore
 from spreadsheet import Spreadsheet
 
 
@@ -34,10 +34,11 @@ from spreadsheet import Spreadsheet
 def main(argv = sys.argv[1:]):
     parser = argparse.ArgumentParser(description='Command line for filtering noncompliant participants from best-worst data.')
     parser.add_argument("scores", type=str, help="Path to a file containing scores computed over all users (including noncompliant ones).")
-    parser.add_argument("input", nargs="*", type=str, help="Path to a file(s) containing trial-level data.")
+    parser.add_argument("input", nargs="*", type=str, help="Path to a file(s) containing trial-level data. May be CSV/TSV files or trial stores (.bwt).")
     parser.add_argument("--id_column", type=str, default=None, help="A column in your input data that specifies user ID. If no value is supplied, uses the name of the file.")
     parser.add_argument("--best", type=str, default="best", help="Name of column that holds string of 'best' choice.")
     parser.add_argument("--worst", type=str, default="worst", help="Name of column that holds string of 'worst' choice.")
+    parser.add_argument("--cache", type=str, nargs="?", const=trialstore.CACHE_DIR, default=None, help="Cache parsed input files, so that unchanged files are not parsed again on later runs. Optionally takes the directory to keep the cache in; defaults to %s (or $BESTWORST_CACHE)." % trialstore.CACHE_DIR.replace("%", "%%"))
     parser.add_argument("--score_method", type=str, default="Value", help="The scoring method to calculate compliance by.")
     parser.add_argument("--filter", type=float, default=None, help="If you want to filter users by compliance, specify the threshold here. The output will be the trials for just users who met your threshold of compliance, as a single file. This can be submitted to score_trials.py for rescoring.")
 
@@ -55,16 +56,26 @@ def main(argv = sys.argv[1:]):
     paircount   = { }
     user_trials = { }
     
+    cache = trialstore.TrialCache(args.cache) if args.cache != None else None
     for file in args.input:
-        # if a participant ID column is not specified, use the name of the file.
-        # Otherwise, use values in the specified column to determine ID.
+        # trial stores carry their own participant IDs, fixed when they were
+        # converted.
         id_col = None
-        if args.id_column != None:
-            ss = Spreadsheet.read_csv(file)
-            id_col = ss[args.id_column]
-                        
-        # read in the user's data, calculate compliance for each trial
-        trials = scoring.parse_bestworst_data(file, bestCol=args.best, worstCol=args.worst)
+        if trialstore.is_trial_store(file):
+            store  = trialstore.TrialStore.load(file)
+            id_col = store.participant_labels()
+            trials = list(store.iter_trials())
+
+        else:
+            # if a participant ID column is not specified, use the name of the
+            # file. Otherwise, use values in the specified column to determine ID.
+            if args.id_column != None:
+                ss = Spreadsheet.read_csv(file)
+                id_col = ss[args.id_column]
+
+            # read in the user's data, calculate compliance for each trial
+            trials = scoring.parse_bestworst_data(file, bestCol=args.best, worstCol=args.worst, cache=cache)
+
         # generate a user ID based on the file name
         if id_col == None:
             id_col = [ file ] * len(trials)
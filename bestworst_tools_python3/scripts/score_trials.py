@@ -13,7 +13,8 @@ The underlying latent dimension in this example was intended to be concept
 concreteness.
 
 Your input data may contain other columns (e.g., participant data), but it MUST
-contain these K+2 columns.
+contain these K+2 columns. Trial stores (.bwt) made by trialstore.py can be
+supplied in place of, or alongside, CSV files.
 
 Created by Dr Geoff Hollis
 http://www.ualberta.ca/~hollis
@@ -33,7 +34,7 @@ Parastoo Harati
 p.harati@ualberta.ca
 December 15, 2023
 """
-import sys, argparse, trialgen, math, scoring
+import sys, argparse, trialgen, math, scoring, trialstore
 from spreadsheet import Spreadsheet
 
 
@@ -44,40 +45,52 @@ from spreadsheet import Spreadsheet
 ################################################################################
 def main(argv=sys.argv[1:]):
     parser = argparse.ArgumentParser(description='Command line for scoring best-worst data.')
-    parser.add_argument("input", nargs="*", type=str, help="Path to a file(s) containing data to score.")
-    parser.add_argument("--sep", type=str, default=None, help="Specify the column separator. If None specified, use default (tab for .tsv, comma for all else)")
+    parser.add_argument("input", nargs="*", type=str, help="Path to a file(s) containing data to score. May be CSV/TSV files or trial stores (.bwt).")
+    parser.add_argument("--sep", type=str, default=None, help="Specify the column separator. If None specified, use default (tab for .tsv, also when compressed as .tsv.gz etc., comma for all else)")
     parser.add_argument("--name", type=str, default="Word", help="The name of the column we should use for outputting the item. Defaults to 'Word'.")
     parser.add_argument("--best", type=str, default="best", help="Name of column that holds string of 'best' choice.")
     parser.add_argument("--worst", type=str, default="worst", help="Name of column that holds string of 'worst' choice.")
+    parser.add_argument("--max-iters", "--iters", dest="iters", type=int, default=100, help="Maximum number of iterations to run tournament-based methods (Value, Elo, RW) for. Defaults to 100.")
+    parser.add_argument("--collapse", action="store_true", help="Collapse repeated (winner, loser) pairings into weighted unique edges before scoring. The David, BT, and RankCentrality scores then work over unique edges, which is faster and uses less memory when the same pairs recur across participants. Tournament-based methods play one pairing per unique edge each iteration, drawn in proportion to its repeats, so they also run faster, with scores that match those without --collapse to within the variation between runs.")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes to read input files with. Use 0 for one per CPU. Defaults to 1. Worthwhile when there are many input files (e.g., one per participant).")
+    parser.add_argument("--cache", type=str, nargs="?", const=trialstore.CACHE_DIR, default=None, help="Cache parsed input files, so that unchanged files are not parsed again on later runs. Optionally takes the directory to keep the cache in; defaults to %s (or $BESTWORST_CACHE)." % trialstore.CACHE_DIR.replace("%", "%%"))
+    parser.add_argument("--cache_size", type=float, default=trialstore.CACHE_BYTES / 2**20, help="Maximum size of the cache, in megabytes. Least recently used files are dropped from the cache past this size. Defaults to %(default)d.")
+    parser.add_argument("--tol", type=float, default=None, help="If specified, each tournament-based method stops early once an iteration changes none of its scores by more than this fraction of their range (e.g., 0.001). The number of iterations each needed is reported on stderr.")
     
     args = parser.parse_args()
 
-    # go over each supplied input file and collect data
-    trials = [ ]
-    for file in args.input:
-        trials += scoring.parse_bestworst_data(file, bestCol=args.best, worstCol=args.worst, sep=args.sep)
+    # go over each supplied input file and collect data. Trials are streamed
+    # from each CSV file, and trial stores are mapped straight in, all encoded
+    # against one shared vocabulary of items. Files that cannot be read are
+    # reported and skipped.
+    errors  = [ ]
+    cache   = None
+    if args.cache != None:
+        cache = trialstore.TrialCache(args.cache, max_bytes=int(args.cache_size * 2**20))
+    encoded = trialstore.load_encoded(args.input, bestCol=args.best, worstCol=args.worst, sep=args.sep,
+                                      processes=args.jobs if args.jobs > 0 else None, errors=errors,
+                                      cache=cache)
+    for file, message in errors:
+        sys.stderr.write("Skipping %s: %s\n" % (file, message))
+    if len(errors) > 0 and len(errors) == len(args.input):
+        sys.stderr.write("No input files could be read.\n")
+        return 1
         
     # perform scoring. This takes awhile.
-    methods = ["Value","Elo","RW","Best","Worst","Unchosen","BestWorst","ABW","David","ValueLogit","RWLogit","BestWorstLogit"] # "EloLogit",
-    results = scoring.score_trials(trials, methods)
+    methods = ["Value","Elo","RW","Best","Worst","Unchosen","BestWorst","ABW","David","ValueLogit","RWLogit","BestWorstLogit","BT","BTLogit","RankCentrality","RankCentralityLogit","MaxDiffMNL","MaxDiffMNLSE"] # "EloLogit",
+    results = scoring.score_encoded(encoded, methods, iters=args.iters, tol=args.tol, collapse=args.collapse)
+    if args.tol is not None:
+        for learner, epochs in results.epochs.items():
+            sys.stderr.write("%s: %d iterations\n" % (learner, epochs))
 
     # start building table of scored values for each item
-
-    # gotta find eloMin and eloMax
-    #   elos   = [ item.elo for item in results.values() ]
-    #   eloMin = min(elos)
-    #   eloMax = max(elos)
+    scores = [ results.scores(method).tolist() for method in methods ]
     
     # print the header and results
     header = [ args.name ] + methods
     print(",".join(header))
-    for name, data in results.items():
-        # skip dummy items
-        if type(name) != str:
-            continue
-        
-        scores = [ scoring.scoring_methods[method](data) for method in methods ]
-        out    = [ name ] + [ str(score) for score in scores ]
+    for i, name in enumerate(results.entities):
+        out    = [ str(name) ] + [ str(score[i]) for score in scores ]
         print(",".join(out))
     
 if __name__ == "__main__":
@@ -21,8 +21,12 @@ Parastoo Harati
 p.harati@ualberta.ca
 December 15, 2023
 """
-import random, math
-from spreadsheet import Spreadsheet
+import random, math, csv
+from array import array
+import numpy as np
+from spreadsheet import read_cell, open_text, infer_sep
+from tournament import TournamentEngine, LEARNERS
+from estimators import add_dummy_pairings, count_edges, fit_bradley_terry, fit_maxdiff_mnl, fit_rank_centrality
 
 
 
@@ -56,8 +60,99 @@ scoring_methods = {
     "EloLogit"     : lambda item,eloMax,eloMin: item.elo_logit_score(eloMin,eloMax),
     "ValueLogit"   : lambda item: item.value_logit_score(),
     "RWLogit"      : lambda item: item.reswag_logit_score(),
+
+    # Model fits, data taken from PAIRINGS
+    "BT"                  : lambda item: item.bt_score(),
+    "BTLogit"             : lambda item: item.bt_logit_score(),
+    "RankCentrality"      : lambda item: item.rank_centrality_score(),
+    "RankCentralityLogit" : lambda item: item.rank_centrality_logit_score(),
+
+    # Model fits, data taken from TRIALS
+    "MaxDiffMNL"   : lambda item: item.mnl,
+    "MaxDiffMNLSE" : lambda item: item.mnl_se,
+    }
+
+# The same scoring methods, vectorised over an ItemTable. Each call returns one
+# score per item, in the order of table.entities.
+table_scoring_methods = {
+    # data taken from TRIALS
+    "Best"           : lambda table: table.best,
+    "Worst"          : lambda table: table.worst,
+    "Unchosen"       : lambda table: table.trials - table.best - table.worst,
+    "BestWorst"      : lambda table: table.bestworst_score(),
+    "BestWorstLogit" : lambda table: table.bestworst_score(),
+    "ABW"            : lambda table: table.abw_score(),
+    "David"          : lambda table: table.david_unbalanced_score(),
+
+    # data taken from PAIRINGS
+    "Wins"         : lambda table: table.wins,
+    "Losses"       : lambda table: table.losses,
+    "Ties"         : lambda table: table.unranked,
+    "WinLoss"      : lambda table: table.winloss_norm_score(),
+    "WinLossLogit" : lambda table: table.winloss_logit_score(),
+
+    # Tournament methods, data taken from PAIRINGS
+    "Elo"          : lambda table: table.elo,
+    "Value"        : lambda table: table.value,
+    "RW"           : lambda table: table.reswag_score(),
+    "EloLogit"     : lambda table: table.elo_logit_score(table.elo.min(), table.elo.max()),
+    "ValueLogit"   : lambda table: table.value_logit_score(),
+    "RWLogit"      : lambda table: table.reswag_logit_score(),
+
+    # Model fits, data taken from PAIRINGS
+    "BT"                  : lambda table: table.bt_score(),
+    "BTLogit"             : lambda table: table.bt_logit_score(),
+    "RankCentrality"      : lambda table: table.rank_centrality_score(),
+    "RankCentralityLogit" : lambda table: table.rank_centrality_logit_score(),
+
+    # Model fits, data taken from TRIALS
+    "MaxDiffMNL"   : lambda table: table.mnl,
+    "MaxDiffMNLSE" : lambda table: table.mnl_se,
+    }
+
+# The scoring stages each scoring method depends on. Stages are:
+#   counts = trial, best, worst, and unranked counts, plus win/loss tallies
+#            over pairings; all computed in one pass over the trials
+#   graph  = the opponents each item has beaten and lost to (David scores),
+#            built once, directly from the trials
+#   elo, value, rw = the individual tournament learners
+#   bt     = the Bradley-Terry fit (see estimators.py)
+#   rc     = the rank centrality random walk (see estimators.py)
+#   mnl    = the MaxDiff multinomial logit fit, on trials (see estimators.py)
+# Pairings are only compiled if a tournament learner or model fit is needed.
+method_stages = {
+    "Best"           : ("counts",),
+    "Worst"          : ("counts",),
+    "Unchosen"       : ("counts",),
+    "BestWorst"      : ("counts",),
+    "BestWorstLogit" : ("counts",),
+    "ABW"            : ("counts",),
+    "David"          : ("counts", "graph"),
+
+    "Wins"           : ("counts",),
+    "Losses"         : ("counts",),
+    "Ties"           : ("counts",),
+    "WinLoss"        : ("counts",),
+    "WinLossLogit"   : ("counts",),
+
+    "Elo"            : ("elo",),
+    "Value"          : ("value",),
+    "RW"             : ("rw",),
+    "EloLogit"       : ("elo",),
+    "ValueLogit"     : ("value",),
+    "RWLogit"        : ("rw",),
+
+    "BT"             : ("bt",),
+    "BTLogit"        : ("bt",),
+    "RankCentrality"      : ("rc",),
+    "RankCentralityLogit" : ("rc",),
+    "MaxDiffMNL"     : ("mnl",),
+    "MaxDiffMNLSE"   : ("mnl",),
     }
 
+# the stages that play or fit compiled pairings
+PAIRING_STAGES = LEARNERS + ("bt", "rc")
+
 
 
 ################################################################################
@@ -90,6 +185,16 @@ class ItemEntry(object):
         self.reswag_win  = 0.0
         self.reswag_lose = 0.0
 
+        # for bradley-terry scoring
+        self.bt          = 1.0
+
+        # for rank centrality scoring
+        self.rc          = 1.0
+
+        # for maxdiff multinomial logit scoring; utility and standard error
+        self.mnl         = 0.0
+        self.mnl_se      = 0.0
+
         # opponents beat and lost to
         self.beat        = set()
         self.lose        = set()
@@ -102,6 +207,40 @@ class ItemEntry(object):
         winner.beat.add(loser)
         loser.lose.add(winner)
 
+    def play(winner, loser, iteration=1):
+        """Fused form of win_elo, win_value_discrim, and win_reswag: applies
+           the same Elo, Value, and Rescorla-Wagner updates in a single call.
+           Unlike win, does not tally wins and losses or record opponents,
+           since neither changes from one iteration to the next.
+        """
+        rate = 0.025 / iteration
+
+        # Elo
+        Qw = 10 ** (winner.elo / 400.)
+        Ql = 10 ** (loser.elo / 400.)
+        delta = float(30.0 * (1. - Qw / (Qw + Ql)))
+        winner.elo += delta
+        loser.elo  -= delta
+
+        # Value
+        wval, lval = winner.value, loser.value
+        rwin = wval / (1.0 - wval)
+        rlos = lval / (1.0 - lval)
+        salience = 1.0 - rwin / (rwin + rlos)
+        winner.value += salience * rate * (1.0 - wval)
+        loser.value  += salience * rate * (0   - lval)
+
+        # Rescorla-Wagner; 50/50 in the case of no exposure
+        w_v_tot = winner.reswag_win + winner.reswag_lose
+        l_v_tot = loser.reswag_win + loser.reswag_lose
+        w_pwin  = winner.reswag_win / w_v_tot if w_v_tot != 0 else 0.5
+        l_pwin  = loser.reswag_win  / l_v_tot if l_v_tot != 0 else 0.5
+        rwin = w_pwin / max(0.0001, (1.0 - w_pwin))
+        rlos = l_pwin / max(0.0001, (1.0 - l_pwin))
+        salience = 1.0 - rwin / (rwin + rlos) if rwin + rlos != 0 else 1.0
+        winner.reswag_win += salience * rate * (1.0 - w_v_tot)
+        loser.reswag_lose += salience * rate * (1.0 - l_v_tot)
+
     def win_value_discrim(winner, loser, iteration):
         """Update Value Score based on win/loss
         """
@@ -238,6 +377,27 @@ class ItemEntry(object):
         rw = min(max(rw, 0.0001), 0.9999)
         return math.log(rw/(1.0-rw))
 
+    def bt_score(self):
+        """Bradley-Terry score: the probability of beating an item of average
+           strength
+        """
+        return self.bt / (1.0 + self.bt)
+
+    def bt_logit_score(self):
+        """logit-adjusted Bradley-Terry score; the log strength
+        """
+        return math.log(self.bt)
+
+    def rank_centrality_score(self):
+        """rank centrality score, on the same scale as the Bradley-Terry score
+        """
+        return self.rc / (1.0 + self.rc)
+
+    def rank_centrality_logit_score(self):
+        """logit-adjusted rank centrality score; the log strength
+        """
+        return math.log(self.rc)
+
     def elo_logit_score(self, eloMin, eloMax):
         """Calculates the logit elo value after scaling between min and max
            elo values.
@@ -246,53 +406,274 @@ class ItemEntry(object):
         # avoid div0 errors
         scaleelo = min(max(scaleelo, 0.0001), 0.9999)
         return math.log(scaleelo / (1.0 - scaleelo))
+
+
+class ItemTable(object):
+    """Struct-of-arrays counterpart to a dict of ItemEntry objects. Each column
+       is a NumPy array with one value per item, in the order of entities, and
+       the opponents each item has beaten and lost to are stored as CSR
+       adjacency (indptr, indices) over item indices, built once.
+    """
+    __slots__ = ("entities", "index", "n_items",
+                 "trials", "best", "worst", "unranked", "wins", "losses",
+                 "elo", "value", "reswag_win", "reswag_lose", "bt", "rc",
+                 "mnl", "mnl_se", "beat_indptr", "beat_indices", "lose_indptr", "lose_indices",
+                 "epochs")
+
+    def __init__(self, entities, base=0):
+        self.entities = list(entities)
+        self.index    = { entity : i for i, entity in enumerate(self.entities) }
+        self.n_items  = n = len(self.entities)
+
+        # for win-loss COUNTING and SCORING
+        self.trials   = np.zeros(n, dtype=np.int64)
+        self.best     = np.zeros(n, dtype=np.int64)
+        self.worst    = np.zeros(n, dtype=np.int64)
+        self.unranked = np.zeros(n, dtype=np.int64)
+        self.wins     = np.zeros(n, dtype=np.int64)
+        self.losses   = np.zeros(n, dtype=np.int64)
+
+        # for tournament scoring
+        self.elo         = np.full(n, float(base))
+        self.value       = np.full(n, 0.5)
+        self.reswag_win  = np.zeros(n)
+        self.reswag_lose = np.zeros(n)
+
+        # for bradley-terry scoring
+        self.bt          = np.ones(n)
+
+        # for rank centrality scoring
+        self.rc          = np.ones(n)
+
+        # for maxdiff multinomial logit scoring; utility and standard error
+        self.mnl         = np.zeros(n)
+        self.mnl_se      = np.zeros(n)
+
+        # the number of epochs each tournament learner was run for
+        self.epochs      = { }
+
+        # opponents beat and lost to
+        self.set_opponents(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+
+    def __len__(self):
+        return self.n_items
+
+    def set_opponents(self, winners, losers):
+        """Builds the beat/lose adjacency from parallel arrays of winner and
+           loser item indices. Repeated pairings are only stored once.
+        """
+        n     = max(self.n_items, 1)
+        keys  = np.unique(np.asarray(winners, dtype=np.int64) * n + np.asarray(losers, dtype=np.int64))
+        beat_rows, beat_cols = keys // n, keys % n
+        order = np.lexsort((beat_rows, beat_cols))
+
+        self.beat_indptr  = np.zeros(self.n_items + 1, dtype=np.int64)
+        self.lose_indptr  = np.zeros(self.n_items + 1, dtype=np.int64)
+        np.cumsum(np.bincount(beat_rows, minlength=self.n_items), out=self.beat_indptr[1:])
+        np.cumsum(np.bincount(beat_cols, minlength=self.n_items), out=self.lose_indptr[1:])
+        self.beat_indices = beat_cols.astype(np.int32)
+        self.lose_indices = beat_rows[order].astype(np.int32)
+
+    def scores(self, method):
+        """Returns the named scoring method's score for every item.
+        """
+        if method not in table_scoring_methods:
+            raise Exception("Unknown scoring method: %s. Options are: %s." % (str(method), ", ".join(table_scoring_methods.keys())))
+        return np.asarray(table_scoring_methods[method](self))
+
+    def to_entries(self):
+        """Converts the table into a dictionary of ItemEntry objects, keyed by
+           item, as returned by score_trials.
+        """
+        entries = [ ItemEntry(entity) for entity in self.entities ]
+        columns = [ (name, getattr(self, name).tolist()) for name in
+                    ("trials", "best", "worst", "unranked", "wins", "losses",
+                     "elo", "value", "reswag_win", "reswag_lose", "bt",
+                     "rc", "mnl", "mnl_se") ]
+        beat_indptr, beat_indices = self.beat_indptr.tolist(), self.beat_indices.tolist()
+        lose_indptr, lose_indices = self.lose_indptr.tolist(), self.lose_indices.tolist()
+        for i, entry in enumerate(entries):
+            for name, values in columns:
+                setattr(entry, name, values[i])
+            entry.beat = set(entries[j] for j in beat_indices[beat_indptr[i]:beat_indptr[i+1]])
+            entry.lose = set(entries[j] for j in lose_indices[lose_indptr[i]:lose_indptr[i+1]])
+        return { entry.entity : entry for entry in entries }
+
+    ############################################################################
+    # SCORING FUNCTIONS
+    ############################################################################
+    def david_unbalanced_score(self):
+        """Calculates the score proposed by H. David (1987)
+        """
+        n    = self.n_items
+        rows = np.repeat(np.arange(n), np.diff(self.beat_indptr))
+        wsum = np.bincount(rows, weights=self.wins[self.beat_indices], minlength=n)
+        rows = np.repeat(np.arange(n), np.diff(self.lose_indptr))
+        lsum = np.bincount(rows, weights=self.losses[self.lose_indices], minlength=n)
+        return (wsum - lsum).astype(np.int64)
+
+    def winloss_norm_score(self):
+        # should range between [-1, 1]
+        winloss = (self.wins - self.losses) / np.maximum(1.0, self.wins + self.losses + self.unranked)
+
+        # normalize to [0, 1]
+        return (winloss + 1.0) / 2.0
+
+    def winloss_logit_score(self):
+        # to avoid div0 errors
+        wln = np.clip(self.winloss_norm_score(), 0.0001, 0.9999)
+        return np.log(wln / (1.0-wln))
+
+    def bestworst_score(self):
+        """normalized bestworst score"""
+        # scales between [-1, 1]
+        bestworst = (self.wins - self.losses) / self.trials
+
+        # rescale to [0, 1]
+        return (bestworst + 1.0) / 2.0
+
+    def bestworst_logit_score(self):
+        # avoid div0 errors
+        bw = np.clip(self.bestworst_score(), 0.0001, 0.9999)
+        return np.log(bw/(1.0-bw))
+
+    def abw_score(self):
+        """calculates analytic best-worst score (Marley, Islam, & Hawkins, 2016)
+        """
+        # to avoid div0 errors
+        ratio = np.clip((self.best - self.worst) / self.trials, -0.9999, 0.9999)
+        return np.log((1.0 + ratio) / (1.0 - ratio))
+
+    def value_logit_score(self):
+        # to avoid div0 errors
+        value = np.clip(self.value, 0.0001, 0.9999)
+        return np.log(value/(1.0-value))
+
+    def reswag_score(self):
+        """calculates rescorla-wagner score based on associations with win
+           and loss outcomes
+        """
+        total = self.reswag_win + self.reswag_lose
+        return np.divide(self.reswag_win, total, out=np.full(self.n_items, 0.5), where=total != 0)
+
+    def reswag_logit_score(self):
+        """logit-adjusted rescorla-wagner score
+        """
+        # to avoid div0 errors
+        rw = np.clip(self.reswag_score(), 0.0001, 0.9999)
+        return np.log(rw/(1.0-rw))
+
+    def bt_score(self):
+        """Bradley-Terry score: the probability of beating an item of average
+           strength
+        """
+        return self.bt / (1.0 + self.bt)
+
+    def bt_logit_score(self):
+        """logit-adjusted Bradley-Terry score; the log strength
+        """
+        return np.log(self.bt)
+
+    def rank_centrality_score(self):
+        """rank centrality score, on the same scale as the Bradley-Terry score
+        """
+        return self.rc / (1.0 + self.rc)
+
+    def rank_centrality_logit_score(self):
+        """logit-adjusted rank centrality score; the log strength
+        """
+        return np.log(self.rc)
+
+    def elo_logit_score(self, eloMin, eloMax):
+        """Calculates the logit elo value after scaling between min and max
+           elo values.
+        """
+        # avoid div0 errors
+        scaleelo = np.clip((self.elo - eloMin) / (eloMax-eloMin), 0.0001, 0.9999)
+        return np.log(scaleelo / (1.0 - scaleelo))
         
         
 
 ################################################################################
 # SUPPORT FUNCTIONS
 ################################################################################
-def parse_bestworst_data(file, bestCol="best", worstCol="worst", sep=None):
-    """parses best-worst data from file, where each trial is returned as tuple:
-         (best, worst, (unchosen1, unchosen2, ..., unchosen[K-2]))
+def iter_bestworst_rows(file, bestCol="best", worstCol="worst", sep=None, extraCols=()):
+    """Streams the raw content of best-worst data from file, one row at a
+       time, as tuples:
+         (best, worst, (option1, option2, ..., optionK), (extra1, extra2, ...))
+
+       where the options are all K choosable items, in presentation order,
+       and the extras are the values of the columns named in extraCols.
 
-       A list of parsed trials is returned.
+       The header is read once, and the best, worst, option, and extra
+       columns are located up front; rows are then read and converted one at
+       a time, so the whole file is never held in memory. Cells are converted
+       as Spreadsheet.read_csv would convert them, but only once per distinct
+       value.
     """
     # figure out our seperator first
-    if sep == None and file.endswith(".tsv"):
-        sep = "\t"
-    elif sep == None:
-        sep = ","
-
-    # read in the trials
-    ss = Spreadsheet.read_csv(file, delimiter=sep)
-    trials = [ ]
-    for row in ss:
-        # read best and worst choices
-        best  = row[bestCol]
-        worst = row[worstCol]
-        opts  = [ ]
-
-        # read all options that were choosable
-        i = 1
-        while True:
-            col = "option%d" % i
-            if col in ss.header:
-                opts.append(row[col])
-                i  += 1
-            else:
-                break
+    if sep == None:
+        sep = infer_sep(file)
+
+    with open_text(file, newline='') as f:
+        reader = csv.reader(f, delimiter=sep)
+        header = next(reader, None)
+        if header == None:
+            return
+        colmap = { col : i for i, col in enumerate(header) }
+        for col in (bestCol, worstCol) + tuple(extraCols):
+            if col not in colmap:
+                raise Exception("No such column in %s: %s" % (file, str(col)))
+        best_i, worst_i = colmap[bestCol], colmap[worstCol]
+        extra_is = [ colmap[col] for col in extraCols ]
+
+        # find all options that were choosable
+        opt_is = [ ]
+        while "option%d" % (len(opt_is) + 1) in colmap:
+            opt_is.append(colmap["option%d" % (len(opt_is) + 1)])
+
+        cells = { }
+        def cell(v):
+            if v not in cells:
+                cells[v] = read_cell(v)
+            return cells[v]
+
+        for row in reader:
+            if len(row) == 0:
+                continue
+            yield (cell(row[best_i]), cell(row[worst_i]),
+                   tuple([ cell(row[i]) for i in opt_is ]),
+                   tuple([ cell(row[i]) for i in extra_is ]))
 
+def iter_bestworst_data(file, bestCol="best", worstCol="worst", sep=None):
+    """Streams best-worst data from file, one trial at a time, as tuples:
+         (best, worst, (unchosen1, unchosen2, ..., unchosen[K-2]))
+
+       Rows are read as by iter_bestworst_rows, so the whole file is never
+       held in memory.
+    """
+    for best, worst, opts, extras in iter_bestworst_rows(file, bestCol=bestCol, worstCol=worstCol, sep=sep):
         # strip best and worst choices from the list of other options
+        opts = list(opts)
         if best in opts:
             opts.remove(best)
         if worst in opts:
             opts.remove(worst)
 
-        trials.append((best, worst, tuple(opts)))
+        yield (best, worst, tuple(opts))
+
+def parse_bestworst_data(file, bestCol="best", worstCol="worst", sep=None, cache=None):
+    """parses best-worst data from file, where each trial is returned as tuple:
+         (best, worst, (unchosen1, unchosen2, ..., unchosen[K-2]))
 
-    # return the parsed trials
-    return trials
+       A list of parsed trials is returned. See iter_bestworst_data to read
+       trials one at a time instead. If a cache is supplied (see
+       trialstore.TrialCache), the file is only parsed if it has changed
+       since it was last cached.
+    """
+    if cache != None:
+        return list(cache.load(file, bestCol=bestCol, worstCol=worstCol, sep=sep).iter_trials())
+    return list(iter_bestworst_data(file, bestCol=bestCol, worstCol=worstCol, sep=sep))
 
 def compile_pairings(trials):
     """Takes a list of trials in the format (best, worst, (others)) and 
@@ -312,47 +693,228 @@ def compile_pairings(trials):
 def run_error_correction_scoring(item_data, pairings, iters=100):
     """run our various error-correction scoring methods on entries in item_data
        according to the (winner, loser) pairings supplied. Makes changes to
-       item_data in place, and returns the results as well.
+       item_data in place, and returns the results as well. Only Elo, Value,
+       and Rescorla-Wagner scores are updated; score_trials tallies wins and
+       losses, and registers opponents, once rather than every iteration.
+       pairings itself is not modified.
     """
+    order = list(range(len(pairings)))
+
     # repeat iter number of times
     for i in range(iters):
-        # shuffle our data to eliminate order effects
-        random.shuffle(pairings)
+        # shuffle the order of play to eliminate order effects
+        random.shuffle(order)
 
         # register a pairing in the item data
-        for winner,loser in pairings:
-            winner_data, loser_data = item_data[winner], item_data[loser]
-            winner_data.win(loser_data, iteration=(i+1))
+        iteration = i+1
+        for j in order:
+            winner, loser = pairings[j]
+            item_data[winner].play(item_data[loser], iteration)
 
     # values were updated in-place; return original data structure
     return item_data
 
-def score_trials(trials, methods, iters=100, dummy=True):
+def run_array_scoring(table, winners, losers, iters=100, learners=LEARNERS, dummy=True, tol=None, counts=None):
+    """Same as run_error_correction_scoring, but for an ItemTable. Plays the
+       pairings given by winners and losers, parallel int32 arrays of item
+       indices, on a TournamentEngine, running only the named learners (elo,
+       value, rw), and copies their final state back into the table. If dummy
+       is True, an always-win and an always-lose dummy player are added, with
+       one pairing against each item. If counts is given, the pairings are
+       unique edges weighted by counts (see collapse_pairings), and each
+       epoch plays one pairing per edge, drawn in proportion to counts (see
+       TournamentEngine.run). If tol is given, each learner stops early once
+       its scores converge, and the number of epochs it needed is recorded
+       in table.epochs. Makes changes to table in place, and returns it as
+       well.
+    """
+    n = table.n_items
+    if dummy == True and counts is None:
+        winners, losers = add_dummy_pairings(winners, losers, n)
+    elif dummy == True:
+        winners, losers, counts = add_dummy_pairings(winners, losers, n, counts)
+
+    engine = TournamentEngine(n + 2 * int(dummy == True))
+    engine.run(winners, losers, iters=iters, learners=learners, tol=tol, counts=counts)
+    table.epochs = dict(engine.epochs)
+
+    table.elo[:]         = engine.elo[:n]
+    table.value[:]       = engine.value[:n]
+    table.reswag_win[:]  = engine.reswag_win[:n]
+    table.reswag_lose[:] = engine.reswag_lose[:n]
+    return table
+
+def register_opponents(item_data, trials):
+    """Records, for every item in item_data, the opponents it has beaten and
+       lost to in trials: best beats worst and every other item, and every
+       other item beats worst. The graph does not depend on pairing order, so
+       it is built once, straight from the trials.
+    """
+    for trial in trials:
+        best, worst, others = trial
+        best_data, worst_data = item_data[best], item_data[worst]
+        best_data.beat.add(worst_data)
+        worst_data.lose.add(best_data)
+        for other in others:
+            other_data = item_data[other]
+            best_data.beat.add(other_data)
+            other_data.lose.add(best_data)
+            other_data.beat.add(worst_data)
+            worst_data.lose.add(other_data)
+    return item_data
+
+def encode_trials(trials, index=None):
+    """Encodes trials in the format (best, worst, (others)) as integer item
+       indices. Items are numbered in order of first appearance, continuing
+       from index if one is supplied. trials may be any iterable, and is only
+       read once, so trials can be streamed from iter_bestworst_data. Returns
+       a tuple of:
+         index    = dictionary mapping each item to its integer index
+         bests    = int32 array of best item indices, one per trial
+         worsts   = int32 array of worst item indices, one per trial
+         others   = int32 array of other item indices, all trials concatenated
+         n_others = int32 array of the number of others in each trial
+    """
+    if index is None:
+        index = { }
+    bests, worsts, others_flat, n_others = array('i'), array('i'), array('i'), array('i')
+    for trial in trials:
+        best, worst, others = trial
+        for item in (best, worst) + tuple(others):
+            if item not in index:
+                index[item] = len(index)
+        bests.append(index[best])
+        worsts.append(index[worst])
+        others_flat.extend([ index[other] for other in others ])
+        n_others.append(len(others))
+    return (index,
+            np.array(bests,       dtype=np.int32),
+            np.array(worsts,      dtype=np.int32),
+            np.array(others_flat, dtype=np.int32),
+            np.array(n_others,    dtype=np.int32))
+
+def encode_trial_matrix(bests, worsts, others, n_others):
+    """Arranges trials as returned by encode_trials into an (n_trials, K)
+       int32 matrix of item indices: the best item in column 0, the worst in
+       column 1, and the others after. K is the size of the largest trial,
+       and smaller trials are padded with -1.
+    """
+    n_trials = len(bests)
+    K        = 2 + (int(n_others.max()) if n_trials > 0 else 0)
+    options  = np.full((n_trials, K), -1, dtype=np.int32)
+    options[:,0] = bests
+    options[:,1] = worsts
+    starts   = np.cumsum(n_others) - n_others
+    rows     = np.repeat(np.arange(n_trials), n_others)
+    options[rows, 2 + np.arange(len(others)) - np.repeat(starts, n_others)] = others
+    return options
+
+def compile_encoded_pairings(bests, worsts, others, n_others):
+    """The integer-encoded counterpart of compile_pairings. Takes trials as
+       returned by encode_trials, and returns the same pairings as two
+       parallel int32 arrays of (winner, loser) item indices, grouped by kind
+       rather than by trial.
+    """
+    winners = np.concatenate((bests,  np.repeat(bests, n_others), others)).astype(np.int32)
+    losers  = np.concatenate((worsts, others, np.repeat(worsts, n_others))).astype(np.int32)
+    return winners, losers
+
+def collapse_pairings(winners, losers, n_items):
+    """Collapses the pairings given by winners and losers, parallel arrays of
+       item indices, into unique directed edges. The same (winner, loser) pair
+       typically recurs across participants, and each recurrence carries no
+       new information for the graph or the model fits. Returns int32 arrays
+       of edge winners, edge losers, and the number of pairings each edge
+       stands for.
+    """
+    winners, losers, counts = count_edges(winners, losers, max(n_items, 1))
+    return winners.astype(np.int32), losers.astype(np.int32), counts.astype(np.int32)
+
+def plan_scoring(methods):
+    """Returns the set of scoring stages (see method_stages) that must be run
+       to compute the named scoring methods. A "pairings" stage is included if
+       any later stage needs compiled pairings.
+    """
+    stages = set()
+    for method in methods:
+        if method not in method_stages:
+            raise Exception("Unknown scoring method: %s. Options are: %s." % (str(method), ", ".join(method_stages.keys())))
+        stages.update(method_stages[method])
+    if len(stages.intersection(PAIRING_STAGES)) > 0:
+        stages.add("pairings")
+    return stages
+
+def score_uncertainty(table, method="MaxDiffMNL"):
+    """Returns a tuple of (scores, uncertainty) for every item in an ItemTable,
+       in the order of table.entities: each item's score under method, and an
+       estimate of its standard error. MaxDiffMNL scores use the standard
+       errors of the fit. For any other method, the standard error is
+       approximated as the spread of scores over the square root of the
+       number of trials each item appeared in, so the table must have been
+       scored with trial counts (any count-based method).
+    """
+    scores = np.asarray(table.scores(method), dtype=np.float64)
+    if method == "MaxDiffMNL":
+        return scores, np.asarray(table.mnl_se, dtype=np.float64)
+    spread = scores.std() if len(scores) > 1 and scores.std() > 0 else 1.0
+    return scores, spread / np.sqrt(np.maximum(table.trials, 1))
+
+def score_trials(trials, methods, iters=100, dummy=True, engine="array", tol=None,
+                 collapse=False):
     """The wrapper function for scoring trials. Parameters are:
          iters   = for error-correction methods (elo, Value, RescorlaWagner),the
                    number of iterations over the data to perform when scoring.
+                   If tol is given, this is the maximum number of iterations.
+         tol     = if not None, each error-correction method stops once an
+                   iteration moves none of its scores by more than tol times
+                   their spread (see TournamentEngine.run). Only supported by
+                   the array engine.
+         collapse= if True, repeated (winner, loser) pairings are collapsed
+                   into weighted unique edges (see collapse_pairings) before
+                   scoring. The graph and the model fits (BT, rank
+                   centrality) then work over unique edges, and each epoch
+                   of the error-correction methods plays one pairing per
+                   edge, drawn in proportion to its repeats; their scores
+                   match those without collapsing to within the variation
+                   between runs. Only supported by the array engine.
          dummy   = Whether always-win and always-lose dummy players should be
                    added to keep items in a bounded range for error-correction
                    methods. Highly suggested.
-         methods = The different scoring methods to apply.
+         methods = The different scoring methods to apply. Only the stages
+                   these methods depend on are run (see plan_scoring).
+         engine  = "array" scores trials with score_table and the NumPy-backed
+                   TournamentEngine (see tournament.py). "reference" runs
+                   error-correction methods through ItemEntry.play, one method
+                   call per pairing.
+
+       Returns a dictionary of ItemEntry objects, keyed by item.
     """
-    # first, extract out all of our unique items
-    items = set()
-    for trial in trials:
-        best, worst, others = trial
-        items.add(best)
-        items.add(worst)
-        for other in others:
-            items.add(other)
+    if engine == "array":
+        return score_table(trials, methods, iters=iters, dummy=dummy, tol=tol,
+                           collapse=collapse).to_entries()
+    elif engine != "reference":
+        raise Exception("Unknown scoring engine: %s. Options are: array, reference." % str(engine))
+    elif tol is not None:
+        raise Exception("Early stopping (tol) is only supported by the array engine.")
+    elif collapse == True:
+        raise Exception("Collapsing pairings is only supported by the array engine.")
 
-    # create data for each item
-    item_data = { }
-    for item in items:
-        item_data[item] = ItemEntry(item)
+    stages   = plan_scoring(methods)
+    learners = tuple(learner for learner in LEARNERS if learner in stages)
+    counting = "counts" in stages
 
-    # calculate scores from count-based methods 
+    # extract out all of our unique items, and in the same pass, calculate
+    # scores from count-based methods. Each trial produces these pairings:
+    # best beats worst and every other item, and every other item beats worst.
+    item_data = { }
     for trial in trials:
-        winner, loser, others      = trial
+        winner, loser, others = trial
+        for item in (winner, loser) + others:
+            if item not in item_data:
+                item_data[item] = ItemEntry(item)
+        if counting == False:
+            continue
+
         item_data[winner].best    += 1
         item_data[loser].worst    += 1
         for item in (winner, loser) + others:
@@ -362,25 +924,142 @@ def score_trials(trials, methods, iters=100, dummy=True):
         for item in others:
             item_data[item].unranked += len(others)-1
 
+        # win/loss tallies are accumulated here, rather than by compiling
+        # pairings
+        item_data[winner].wins  += len(others) + 1
+        item_data[loser].losses += len(others) + 1
+        for item in others:
+            item_data[item].wins   += 1
+            item_data[item].losses += 1
+    items = list(item_data.keys())
+
+    # tournament methods re-register every pairing on every iteration, so
+    # tallies are scaled to match. Each item also wins and loses once against
+    # the dummies, if we have them.
+    if counting == True:
+        for item in items:
+            data        = item_data[item]
+            data.wins   = iters * (data.wins   + int(dummy == True))
+            data.losses = iters * (data.losses + int(dummy == True))
+
+    # the opponent graph is fixed by the trials; build it once, up front
+    if "graph" in stages:
+        item_data = register_opponents(item_data, trials)
+
     # now that count-based methods are done, use error-correction methods for
     # scoring. We need to reformat trials into a series of pairings where we
     # know winners and losers, and then calculate scores based on match wins
     # and losses. See Hollis (2017; reference in file header) for details.
+    if "pairings" in stages:
+        pairings = compile_pairings(trials)
         
-    # generate pairings from trials
-    pairings = compile_pairings(trials)
-        
-    # if we have dummy players, add those as well. Also add pairings for each
-    # item and the two dummies.
-    if dummy == True:
-        BEST_WINNER = object()
-        WORST_LOSER = object()
-        item_data[BEST_WINNER] = ItemEntry(BEST_WINNER)
-        item_data[WORST_LOSER] = ItemEntry(WORST_LOSER)
-        for item in items:
-            pairings.append([BEST_WINNER, item])
-            pairings.append([item, WORST_LOSER])
+        # if we have dummy players, add those as well. Also add pairings for
+        # each item and the two dummies.
+        if dummy == True:
+            BEST_WINNER = object()
+            WORST_LOSER = object()
+            item_data[BEST_WINNER] = ItemEntry(BEST_WINNER)
+            item_data[WORST_LOSER] = ItemEntry(WORST_LOSER)
+            for item in items:
+                pairings.append([BEST_WINNER, item])
+                pairings.append([item, WORST_LOSER])
 
     # apply our various error-correction scoring methods
-    item_data = run_error_correction_scoring(item_data, pairings, iters=iters)
+    if len(learners) > 0:
+        item_data = run_error_correction_scoring(item_data, pairings, iters=iters)
+
+    # the Bradley-Terry fit does not depend on pairing order, so it is always
+    # computed by the array-based estimator...
+    if "bt" in stages:
+        index, bests, worsts, others, n_others = encode_trials(trials)
+        winners, losers = compile_encoded_pairings(bests, worsts, others, n_others)
+        strength = fit_bradley_terry(winners, losers, len(index), dummy=dummy).tolist()
+        for item, i in index.items():
+            item_data[item].bt = strength[i]
+
+    # ...as is rank centrality
+    if "rc" in stages:
+        index, bests, worsts, others, n_others = encode_trials(trials)
+        winners, losers = compile_encoded_pairings(bests, worsts, others, n_others)
+        strength = fit_rank_centrality(winners, losers, len(index), dummy=dummy).tolist()
+        for item, i in index.items():
+            item_data[item].rc = strength[i]
+
+    # as is the MaxDiff fit, which works on trials rather than pairings
+    if "mnl" in stages:
+        index, bests, worsts, others, n_others = encode_trials(trials)
+        utility, error = fit_maxdiff_mnl(encode_trial_matrix(bests, worsts, others, n_others),
+                                         len(index), dummy=dummy)
+        for item, i in index.items():
+            item_data[item].mnl    = float(utility[i])
+            item_data[item].mnl_se = float(error[i])
     return item_data
+
+def score_table(trials, methods, iters=100, dummy=True, tol=None, collapse=False):
+    """Scores trials like score_trials, using the array engine, and returns the
+       results as an ItemTable. Scores for each method are available through
+       table.scores(method), in the order of table.entities, and the number of
+       iterations each error-correction method ran for through table.epochs.
+    """
+    # encode every item as an integer index, in order of first appearance
+    return score_encoded(encode_trials(trials), methods, iters=iters, dummy=dummy,
+                         tol=tol, collapse=collapse)
+
+def score_encoded(encoded, methods, iters=100, dummy=True, tol=None, collapse=False):
+    """Same as score_table, but for trials that are already encoded, as
+       returned by encode_trials (or trialstore.TrialStore.encoded).
+    """
+    stages   = plan_scoring(methods)
+    learners = tuple(learner for learner in LEARNERS if learner in stages)
+
+    index, bests, worsts, others_flat, n_others = encoded
+    table = ItemTable(index.keys())
+    n     = table.n_items
+
+    # calculate scores from count-based methods. Each trial produces these
+    # pairings: best beats worst and every other item, and every other item
+    # beats worst.
+    if "counts" in stages:
+        others_count   = np.bincount(others_flat, minlength=n)
+        table.best     = np.bincount(bests,  minlength=n)
+        table.worst    = np.bincount(worsts, minlength=n)
+        table.trials   = table.best + table.worst + others_count
+        table.unranked = np.bincount(others_flat, weights=np.repeat(n_others - 1, n_others),
+                                     minlength=n).astype(np.int64)
+
+        # tournament methods re-register every pairing on every iteration, so
+        # tallies are scaled to match. Each item also wins and loses once
+        # against the dummies, if we have them.
+        wins   = np.bincount(bests,  weights=n_others + 1, minlength=n).astype(np.int64) + others_count
+        losses = np.bincount(worsts, weights=n_others + 1, minlength=n).astype(np.int64) + others_count
+        table.wins   = iters * (wins   + int(dummy == True))
+        table.losses = iters * (losses + int(dummy == True))
+
+    # now that count-based methods are done, use error-correction methods for
+    # scoring. We need to reformat trials into a series of pairings where we
+    # know winners and losers, and then calculate scores based on match wins
+    # and losses. See Hollis (2017; reference in file header) for details.
+    counts = None
+    if "pairings" in stages or "graph" in stages:
+        winners, losers = compile_encoded_pairings(bests, worsts, others_flat, n_others)
+        if collapse == True:
+            winners, losers, counts = collapse_pairings(winners, losers, n)
+
+    # the opponent graph is fixed by the trials; build it once, up front
+    if "graph" in stages:
+        table.set_opponents(winners, losers)
+
+    # apply the requested error-correction scoring methods
+    if len(learners) > 0:
+        table = run_array_scoring(table, winners, losers, iters=iters, learners=learners,
+                                  dummy=dummy, tol=tol, counts=counts)
+
+    # fit the requested statistical models
+    if "bt" in stages:
+        table.bt = fit_bradley_terry(winners, losers, n, dummy=dummy, counts=counts)
+    if "rc" in stages:
+        table.rc = fit_rank_centrality(winners, losers, n, dummy=dummy, counts=counts)
+    if "mnl" in stages:
+        table.mnl, table.mnl_se = fit_maxdiff_mnl(encode_trial_matrix(bests, worsts, others_flat, n_others),
+                                                  n, dummy=dummy)
+    return table
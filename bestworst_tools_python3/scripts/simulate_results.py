@@ -19,8 +19,9 @@ Parastoo Harati
 p.harati@ualberta.ca
 December 15, 2023
 """
-import sys, argparse, scoring, trialgen, random
-from spreadsheet import Spreadsheet
+import sys, argparse, scoring, trialgen
+import numpy as np
+from spreadsheet import Spreadsheet, infer_sep
 from functools import cmp_to_key
 
 
@@ -28,20 +29,39 @@ from functools import cmp_to_key
 ################################################################################
 # HELPER FUNCTIONS
 ################################################################################
-def sort_words(trial, latent_values, noise=0):
-    """Returns a sorted list of the words in trial (not in place), by their
-       latent value, plus added noise.
+def sort_trials(index, values, noise=0, rng=None):
+    """Returns a copy of a trial index matrix (see trialgen.build_index_even)
+       with the items in each trial sorted by their latent value, plus added
+       noise, from highest to lowest. values is an array of the latent value
+       of every item.
     """
-    trial = [ item for item in trial ]
-    if noise == 0:
-        trial.sort(key=lambda item: latent_values[item], reverse=True)
-        return trial
-    
-    tmpvals = { }
-    for item in trial:
-        tmpvals[item] = latent_values[item] + random.gauss(0,noise)
-    trial.sort(key=lambda item: tmpvals[item], reverse=True)
-    return trial
+    keys = values[index]
+    if noise != 0:
+        if rng is None:
+            rng = trialgen.generator_rng()
+        keys = keys + rng.normal(0, noise, size=keys.shape)
+    order = np.argsort(-keys, axis=1, kind="stable")
+    return np.take_along_axis(index, order, axis=1)
+
+def encode_sorted_trials(items, index):
+    """Encodes trials sorted from best to worst, given as an index matrix into
+       items, exactly as scoring.encode_trials would encode the trials
+       (best, worst, (others)).
+    """
+    K     = index.shape[1]
+    seq   = np.concatenate([ index[:,:1], index[:,-1:], index[:,1:-1] ], axis=1)
+
+    # number items in order of first appearance
+    used, first = np.unique(seq.ravel(), return_index=True)
+    used        = used[np.argsort(first)]
+    remap       = np.full(len(items), -1, dtype=np.int32)
+    remap[used] = np.arange(len(used), dtype=np.int32)
+    seq         = remap[seq]
+    return ({ items[i] : j for j, i in enumerate(used) },
+            np.ascontiguousarray(seq[:,0]),
+            np.ascontiguousarray(seq[:,1]),
+            seq[:,2:].ravel(),
+            np.full(len(seq), K - 2, dtype=np.int32))
 
 
 
@@ -54,21 +74,20 @@ def main(argv=sys.argv[1:]):
     parser.add_argument("N", type=int, help="Number of trials to generate for the simulation.")
     parser.add_argument("K", type=int, default=4, help="Number of items per trial, defaults to 4.")
     parser.add_argument("--noise", type=float, default=0.0, help="the sd to use for generating noise on each decision (noise is normally distributed).")
-    parser.add_argument("--generator", type=str, default="even", help="The type of trial generation method for running the simulation. Options are: random, even, norepeat, norepeateven. See Hollis (2017) for details.")
+    parser.add_argument("--generator", type=str, default="even", help="The type of trial generation method for running the simulation. Options are: random, even, norepeat, norepeateven, bibd. See Hollis (2017) for details.")
     parser.add_argument("--sep", type=str, default=None, help="Column seperator for the input file")
     parser.add_argument("--item", type=str, default="Item", help="Column corresponding to item name.")
     parser.add_argument("--latentvalue", type=str, default="LatentValue", help="Column corresponding to latent value name.")
     parser.add_argument("--dummy", type=bool, default=True, help="use a dummy player to bound tournament-based scores.")
-    parser.add_argument("--iters", type=int, default=100, help="Number of iterations to run tournament-based methods for. 100 is likely sufficient to ensure convergence, if not a little overkill.")
+    parser.add_argument("--max-iters", "--iters", dest="iters", type=int, default=100, help="Maximum number of iterations to run tournament-based methods for. 100 is likely sufficient to ensure convergence, if not a little overkill; see --tol.")
+    parser.add_argument("--tol", type=float, default=None, help="If specified, each tournament-based method stops early once an iteration changes none of its scores by more than this fraction of their range (e.g., 0.001). The number of iterations each needed is reported on stderr.")
 
     args = parser.parse_args()
 
     # determine the column seperator for our input data
     sep = args.sep
-    if sep == None and args.input.endswith(".tsv"):
-        sep = "\t"
-    elif sep == None:
-        sep = ","
+    if sep == None:
+        sep = infer_sep(args.input)
     
     # read in latent values from the input data
     latent_values = { }
@@ -83,40 +102,45 @@ def main(argv=sys.argv[1:]):
     K = args.K
     N = args.N
 
-    # generate trials from items
-    trials = [ ]
+    # generate trials from items, as a matrix of item indices
     if args.generator == "norepeateven":
-        trials = trialgen.build_trials_even_bigram_norepeat(items, N=N, K=K)
+        index  = trialgen.collect_index(trialgen.iter_index_even_bigram_norepeat(len(items), N=N, K=K), K)
+    elif args.generator == "bibd":
+        stats  = { }
+        index  = trialgen.collect_index(trialgen.iter_index_bibd(len(items), N=N, K=K, stats=stats), K)
+        if stats["construction"] == "greedy":
+            sys.stderr.write("No cyclic design fits %d items in %d trials of size %d; used norepeateven instead.\n" % (len(items), N, K))
     elif args.generator == 'even':
-        trials = trialgen.build_trials_even(items, N=N, K=K)
+        index  = trialgen.build_index_even(len(items), N=N, K=K)
     elif args.generator == 'random':
-        trials = trialgen.build_trials_random(items, N=N, K=K)
+        index  = trialgen.build_index_random(len(items), N=N, K=K)
     elif args.generator == "norepeat":
-        trials = trialgen.build_trials_random_bigram_norepeat(items, N=N, K=K)
+        stats  = { }
+        index  = trialgen.collect_index(trialgen.iter_index_random_bigram_norepeat(len(items), N=N, K=K, stats=stats), K)
+        if stats["complete"] == False:
+            sys.stderr.write("Only built %d of %d trials without repeating pairs.\n" % (len(index), N))
     else:
-        raise Exception("You must specify a proper generation method: norepeateven, even, random, norepeat.")
+        raise Exception("You must specify a proper generation method: norepeateven, even, random, norepeat, bibd.")
 
-    
-    # sort words in each trial by their latent value, plus noise
-    trials = [ sort_words(trial, latent_values, args.noise) for trial in trials ]
-    
-    # convert the trials into format: (best, worst, (others,))
-    trials = [ (trial[0], trial[-1], tuple(trial[1:-1])) for trial in trials ]
+    # sort words in each trial by their latent value, plus noise, and encode
+    # them as (best, worst, (others,))
+    values  = np.array([ latent_values[item] for item in items ], dtype=np.float64)
+    index   = sort_trials(index, values, args.noise)
+    encoded = encode_sorted_trials(items, index)
 
     # perform scoring. This takes awhile.
-    methods = ["Value","Elo","RW","Best","Worst","Unchosen","BestWorst","ABW","David","ValueLogit","RWLogit","BestWorstLogit"]
-    results = scoring.score_trials(trials, methods, iters=args.iters, dummy=args.dummy)
+    methods = ["Value","Elo","RW","Best","Worst","Unchosen","BestWorst","ABW","David","ValueLogit","RWLogit","BestWorstLogit","BT","BTLogit","RankCentrality","RankCentralityLogit","MaxDiffMNL"]
+    results = scoring.score_encoded(encoded, methods, iters=args.iters, dummy=args.dummy, tol=args.tol)
+    if args.tol is not None:
+        for learner, epochs in results.epochs.items():
+            sys.stderr.write("%s: %d iterations\n" % (learner, epochs))
+    scores  = [ results.scores(method).tolist() for method in methods ]
 
     # print the header and results
     header = [ args.item, args.latentvalue ] + methods
     print(",".join(header))
-    for name, data in results.items():
-        # skip dummy items
-        if type(name) != str:
-            continue
-        
-        scores = [ scoring.scoring_methods[method](data) for method in methods ]
-        out    = [ name, latent_values[name] ] + [ str(score) for score in scores ]
+    for i, name in enumerate(results.entities):
+        out    = [ name, latent_values[name] ] + [ str(score[i]) for score in scores ]
         print(",".join([ str(v) for v in out ]))
 
 if __name__ == "__main__":
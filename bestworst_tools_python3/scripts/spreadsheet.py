@@ -1,14 +1,64 @@
 """
 spreadsheet.py
 
-implements a basic spreadsheet with column and row references
+implements a basic spreadsheet with column and row references, plus a
+columnar variant that converts cells lazily, one column at a time. Files
+compressed with gzip (.gz), bzip2 (.bz2), xz (.xz), or zstandard (.zst; needs
+the zstandard package) are decompressed as they are read.
 
 Python 3 migration, refactor, and GUI build:
 Parastoo Harati
 p.harati@ualberta.ca
 December 15, 2023
 """
-import csv
+import csv, itertools, io, gzip, bz2, lzma
+import numpy as np
+
+# zstandard is optional; it is only needed to read .zst files
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def open_zstd(fname, mode="rt", encoding=None, newline=None):
+    """opens a zstandard-compressed file for reading as text
+    """
+    if zstandard == None:
+        raise Exception("Reading %s requires the zstandard package (pip install zstandard)." % fname)
+    stream = zstandard.ZstdDecompressor().stream_reader(open(fname, "rb"), closefd=True)
+    return io.TextIOWrapper(stream, encoding=encoding, newline=newline)
+
+# how to open files with each compression suffix
+COMPRESSED_OPENERS = { ".gz"  : gzip.open,
+                       ".bz2" : bz2.open,
+                       ".xz"  : lzma.open,
+                       ".zst" : open_zstd }
+
+def strip_compression(fname):
+    """returns fname without any compression suffix, e.g., data.tsv.gz ->
+       data.tsv
+    """
+    for suffix in COMPRESSED_OPENERS:
+        if fname.endswith(suffix):
+            return fname[:-len(suffix)]
+    return fname
+
+def infer_sep(fname):
+    """returns the column separator to use for fname by default: tab for .tsv
+       files (compressed or not), and comma for all else
+    """
+    if strip_compression(fname).endswith(".tsv"):
+        return "\t"
+    return ","
+
+def open_text(fname, newline=None):
+    """opens fname for reading as text, decompressing it on the fly if it has
+       a compression suffix
+    """
+    for suffix, opener in COMPRESSED_OPENERS.items():
+        if fname.endswith(suffix):
+            return opener(fname, mode="rt", newline=newline)
+    return open(fname, 'r', newline=newline)
 
 def read_cell(v):
     try:
@@ -62,10 +112,15 @@ class Spreadsheet(object):
         raise Exception("No such column name or row number in Spreadsheet")
 
     @staticmethod
-    def read_csv(fname,header=True,*args,**kwargs):
-        """reads in a spreadsheet from a csv file
+    def read_csv(fname,header=True,*args,columnar=False,dtypes=None,**kwargs):
+        """reads in a spreadsheet from a csv file. If columnar is True, a
+           ColumnarSpreadsheet is returned instead, with column types taken
+           from dtypes where given (see ColumnarSpreadsheet).
         """
-        with open(fname, 'r') as f:
+        if columnar == True:
+            return ColumnarSpreadsheet.read_csv(fname, header, *args, dtypes=dtypes, **kwargs)
+
+        with open_text(fname) as f:
             reader = csv.reader(f,*args,**kwargs)
             rows   = [ ]
             for row in reader:
@@ -76,3 +131,92 @@ class Spreadsheet(object):
                     rows.append(row)
                     
             return Spreadsheet(header, rows)
+
+
+class ColumnarSpreadsheet(object):
+    """A spreadsheet stored by column rather than by row. Cells are kept as
+       the raw strings read from file, and a column is only converted the
+       first time it is accessed by name; the result is cached. Numeric
+       columns are converted in one go to NumPy arrays (int64 if every value
+       is whole, float64 otherwise). Other columns are converted cell by cell
+       with read_cell, exactly as Spreadsheet would convert them.
+
+       dtypes optionally maps column names to int, float, or str, to skip
+       inference for those columns; str columns are left as raw strings.
+    """
+    def __init__(self, header, columns, dtypes=None):
+        self.header  = [h for h in header]
+        self.colmap  = { }
+        for i in range(len(self.header)):
+            self.colmap[self.header[i]] = i
+        self.raw     = [ list(column) for column in columns ]
+        self.dtypes  = dict(dtypes) if dtypes != None else { }
+        self.columns = { }
+
+    def __iter__(self):
+        return iter(self[i] for i in range(len(self)))
+
+    def __len__(self):
+        if len(self.raw) == 0:
+            return 0
+        return len(self.raw[0])
+
+    def __getitem__(self, v):
+        """get a row number, or a column name
+        """
+        if type(v) == int:
+            return SpreadsheetRow(self.colmap, [ self.column(h)[v] for h in self.header ])
+        elif v in self.colmap:
+            return self.column(v)
+        raise Exception("No such column name or row number in Spreadsheet")
+
+    def column(self, name):
+        """returns the converted values of the named column
+        """
+        if name not in self.columns:
+            raw   = self.raw[self.colmap[name]]
+            dtype = self.dtypes.get(name, None)
+            if dtype == str:
+                self.columns[name] = raw
+            elif dtype == int:
+                self.columns[name] = np.array(raw, dtype=np.float64).astype(np.int64)
+            elif dtype == float:
+                self.columns[name] = np.array(raw, dtype=np.float64)
+            else:
+                self.columns[name] = ColumnarSpreadsheet.infer_column(raw)
+        return self.columns[name]
+
+    @staticmethod
+    def infer_column(raw):
+        """converts a column of raw strings by the same rules as read_cell:
+           to an int64 array if read_cell would make every cell an int, to a
+           float64 array if it would make every cell a float (including nan
+           and inf), and cell by cell with read_cell otherwise (e.g., text, or
+           a mix of ints and floats).
+        """
+        try:
+            values = np.array(raw, dtype=np.float64)
+        except ValueError:
+            return [ read_cell(v) for v in raw ]
+        whole = np.isfinite(values)
+        whole[whole] = values[whole] == np.floor(values[whole])
+        if whole.all() and (np.abs(values) < 2**53).all():
+            return values.astype(np.int64)
+        if not whole.any():
+            return values
+        return [ read_cell(v) for v in raw ]
+
+    @staticmethod
+    def read_csv(fname,header=True,*args,dtypes=None,**kwargs):
+        """reads in a columnar spreadsheet from a csv file, without converting
+           any cells
+        """
+        with open_text(fname) as f:
+            reader = csv.reader(f,*args,**kwargs)
+            if header is True:
+                header = next(reader, [ ])
+            rows    = [ row for row in reader ]
+            width   = max([ len(header) ] + [ len(row) for row in rows ])
+            columns = list(itertools.zip_longest(*rows, fillvalue=""))
+            columns += [ ("",) * len(rows) ] * (width - len(columns))
+            return ColumnarSpreadsheet(header, columns, dtypes=dtypes)
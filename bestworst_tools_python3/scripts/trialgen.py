@@ -1,7 +1,11 @@
 """
 trialgen.py
 
-Various methods for generating best-worst trials from a list of items.
+Various methods for generating best-worst trials from a list of items, and
+for evaluating the quality of a design. To evaluate a design written by
+create_trials.py:
+
+  python3 scripts/trialgen.py evaluate trials.csv
 
 Created by Dr Geoff Hollis
 http://www.ualberta.ca/~hollis
@@ -21,105 +25,1369 @@ Parastoo Harati
 p.harati@ualberta.ca
 December 15, 2023
 """
-import random, itertools
+import sys, argparse, csv, random, itertools, time, math
+import numpy as np
+from spreadsheet import open_text, infer_sep, read_cell
 
 
 
-def build_trials_even_bigram_norepeat(items, N=1, K=4):
-    """Builds N trials with K items each.
+################################################################################
+# VARIABLES
+################################################################################
+
+# random candidates tried for each slot of a trial before giving up on it
+NOREPEAT_TRIES      = 32
+
+# times a trial is restarted from a new first item before a repeated pair is
+# accepted
+NOREPEAT_BACKTRACKS = 8
+
+# attempts the generators may make, per trial or item, before they give up
+NOREPEAT_ATTEMPTS   = 100
+
+# partly built trials the random no-repeat generator may abandon in a row
+# before it stops with what it has
+NOREPEAT_STREAK     = 100
+
+# seconds create_trials gives the random no-repeat generator by default
+NOREPEAT_TIME_LIMIT = 300
+
+# how many trials to build between calls to a progress callback
+PROGRESS_EVERY      = 1000
+
+# how many trials the iter_index_* generators yield at a time
+TRIAL_BATCH         = 100000
+
+# the adaptive generator fills each trial with items scored within this many
+# standard errors of its first item
+ADAPTIVE_SPREAD     = 2.0
+
+# the most times the adaptive generator may show an item, as a multiple of
+# the number of times it would appear in an even design
+ADAPTIVE_SLACK      = 2.0
+
+# items of each adaptive trial taken from the least-shown items, rather than
+# from around its first item, so that a round reaches every item and links
+# the neighbourhoods it concentrates on
+ADAPTIVE_EXPLORE    = 1
+
+
+
+# pairs a PairIndex collects in a set before merging them into its array
+PAIR_BUFFER         = 1 << 18
+
+# sorted runs of pair counts a DesignTally merges at a time
+PAIR_RUNS           = 16
+
+# the most dummy items the bibd generator may pad a cyclic design with, as a
+# multiple of the trial size; each dummy can cost an item one appearance
+BIBD_DUMMIES        = 1
+
+# extra copies the bibd generator may try, once pairs must repeat, if the
+# fewest copies that fit have no cyclic design
+BIBD_COPIES         = 2
+
+
+
+################################################################################
+# CLASSES
+################################################################################
+class PairIndex(object):
+    """The set of unordered pairs of items that have appeared together in a
+       trial, for n items numbered 0 to n-1. Each pair (a, b) is packed into
+       a single int64, min(a,b) * n + max(a,b), so (a, b) and (b, a) are the
+       same pair. Pairs are kept in a sorted int64 array, at 8 bytes each;
+       newly added pairs are collected in a small set first, and merged into
+       the array once there are `buffer` of them.
+
+       Most lookups are for pairs that have not been seen. To answer those
+       without searching the array, every pair also sets one bit in a bitmap
+       sized for `capacity` pairs (2 bytes per pair); a clear bit means the
+       pair is certainly new.
+    """
+    def __init__(self, n, capacity=PAIR_BUFFER, buffer=PAIR_BUFFER):
+        self.n      = n
+        self.buffer = buffer
+        self.pairs  = np.zeros(0, dtype=np.int64)
+        self.recent = set()
+        self.nbits  = 16 * max(capacity, 1024) + 1
+        self.bits   = bytearray(self.nbits // 8 + 1)
+
+    def __len__(self):
+        return len(self.pairs) + len(self.recent)
+
+    def key(self, a, b):
+        """Returns the packed key of the pair (a, b).
+        """
+        return a * self.n + b if a < b else b * self.n + a
+
+    def flush(self):
+        """Merges recently added pairs into the sorted array.
+        """
+        if len(self.recent) > 0:
+            recent      = np.sort(np.fromiter(self.recent, dtype=np.int64, count=len(self.recent)))
+            self.pairs  = np.insert(self.pairs, np.searchsorted(self.pairs, recent), recent)
+            self.recent = set()
+
+    def stored(self, keys):
+        """Returns a boolean array marking which of the packed keys are in the
+           sorted array.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.pairs) == 0:
+            return np.zeros(keys.shape, dtype=bool)
+        pos  = np.searchsorted(self.pairs, keys)
+        return self.pairs[np.minimum(pos, len(self.pairs) - 1)] == keys
+
+    def __contains__(self, key):
+        """True if the packed key has been recorded.
+        """
+        h = key % self.nbits
+        if not (self.bits[h >> 3] >> (h & 7)) & 1:
+            return False
+        return key in self.recent or bool(self.stored([ key ])[0])
+
+    def count(self, item, others):
+        """Returns how many of others have already been paired with item.
+        """
+        return sum(self.key(item, other) in self for other in others)
+
+    def isdisjoint(self, item, others):
+        """True if item has not yet been paired with any of others.
+        """
+        for other in others:
+            if self.key(item, other) in self:
+                return False
+        return True
+
+    def compatible(self, trial):
+        """Returns an array of every item that has not yet been paired with
+           anything in trial, and is not in trial itself.
+        """
+        self.flush()
+        items = np.arange(self.n, dtype=np.int64)
+        ok    = np.ones(self.n, dtype=bool)
+        for other in trial:
+            ok &= ~self.stored(np.minimum(items, other) * self.n + np.maximum(items, other))
+        ok[list(trial)] = False
+        return np.flatnonzero(ok)
+
+    def discard(self, key):
+        """Forgets the packed key, if it has been recorded. Its bit in the
+           bitmap may be shared with other pairs, and is left set.
+        """
+        if key in self.recent:
+            self.recent.discard(key)
+        elif key in self:
+            self.pairs = np.delete(self.pairs, np.searchsorted(self.pairs, key))
+
+    def add(self, pairs, repeated=None):
+        """Records each pair of items (a, b). Returns how many of the pairs
+           had already been recorded; if repeated is a dictionary, each of
+           their keys is also counted in it.
+        """
+        repeats = 0
+        for a, b in pairs:
+            key = self.key(a, b)
+            if key in self:
+                repeats += 1
+                if repeated != None:
+                    repeated[key] = repeated.get(key, 0) + 1
+                continue
+            h = key % self.nbits
+            self.bits[h >> 3] |= 1 << (h & 7)
+            self.recent.add(key)
+        if len(self.recent) >= self.buffer:
+            self.flush()
+        return repeats
+
+
+
+class ExclusionIndex(object):
+    """Pairs of items that must never appear in the same trial, for n items
+       numbered 0 to n-1. Kept as an adjacency: a dict from each constrained
+       item to the set of items it may not appear with, so that checking a
+       pair costs a dict and a set lookup. The same pairs are also kept as a
+       sorted array of packed keys, min(a,b) * n + max(a,b) as in PairIndex,
+       to check whole index matrices at once.
+    """
+    def __init__(self, n, pairs=()):
+        self.n        = n
+        self.adjacent = { }
+        for a, b in pairs:
+            if a != b:
+                self.adjacent.setdefault(a, set()).add(b)
+                self.adjacent.setdefault(b, set()).add(a)
+        keys      = [ a * n + b for a in self.adjacent for b in self.adjacent[a] if a < b ]
+        self.keys = np.unique(np.array(keys, dtype=np.int64))
+
+    @staticmethod
+    def from_groups(n, groups):
+        """Builds an index in which no two items of the same group may appear
+           in a trial together.
+        """
+        return ExclusionIndex(n, itertools.chain.from_iterable(itertools.combinations(group, 2)
+                                                               for group in groups))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def conflicts(self, item, trial):
+        """True if item may not appear with any of the items in trial.
+        """
+        adjacent = self.adjacent.get(item, None)
+        return adjacent != None and not adjacent.isdisjoint(trial)
+
+    def excluded(self, trial):
+        """Returns the set of items that may not appear with some item in
+           trial.
+        """
+        excluded = set()
+        for item in trial:
+            excluded.update(self.adjacent.get(item, ()))
+        return excluded
+
+    def contains(self, keys):
+        """Returns a boolean array marking which of the packed keys are
+           excluded pairs.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.zeros(keys.shape, dtype=bool)
+        pos  = np.searchsorted(self.keys, keys)
+        return self.keys[np.minimum(pos, len(self.keys) - 1)] == keys
+
+    def conflicting(self, index):
+        """Returns a boolean array marking the rows of a trial index matrix
+           that contain an excluded pair.
+        """
+        index = np.asarray(index, dtype=np.int64)
+        bad   = np.zeros(len(index), dtype=bool)
+        for i, j in itertools.combinations(range(index.shape[1]), 2):
+            a, b = index[:,i], index[:,j]
+            bad |= self.contains(np.minimum(a, b) * self.n + np.maximum(a, b))
+        return bad
+
+
+
+class DesignTally(object):
+    """A running summary of a design over n items, with K items per trial,
+       that is fed one batch of trials at a time (e.g., as each is written
+       out), so that the design can be evaluated without keeping it. Holds
+       the number of trials each item appears in, a union-find forest over
+       items for connectivity (see join_components), and the number of
+       trials each pair of items appears in together.
+
+       Pair counts are kept as sorted runs of packed keys and counts (see
+       count_pairs), one per batch. Whenever PAIR_RUNS runs of the same size
+       class build up, they are merged into one of the next class, so each
+       pair is merged only a few times however many batches there are.
+    """
+    def __init__(self, n, K):
+        self.n           = n
+        self.K           = K
+        self.trials      = 0
+        self.duplicates  = 0
+        self.appearances = np.zeros(n, dtype=np.int64)
+        self.parent      = np.arange(n, dtype=np.int64)
+        self.runs        = [ ]
+        self.levels      = [ ]
+
+    def add(self, index):
+        """Adds a batch of trials, as an index matrix.
+        """
+        index = np.asarray(index, dtype=np.int64)
+        if len(index) == 0:
+            return
+        self.trials      += len(index)
+        self.duplicates  += int(has_duplicates(index).sum())
+        self.appearances += np.bincount(index.ravel(), minlength=self.n)
+        self.parent       = join_components(self.parent, index)
+        self.runs.append(count_pairs(index, self.n))
+        self.levels.append(0)
+        while len(self.levels) >= PAIR_RUNS and self.levels[-PAIR_RUNS] == self.levels[-1]:
+            self.runs[-PAIR_RUNS:]   = [ merge_pair_counts(self.runs[-PAIR_RUNS:]) ]
+            self.levels[-PAIR_RUNS:] = [ self.levels[-1] + 1 ]
+
+    def track(self, batches):
+        """Yields each batch of trials unchanged, after adding it.
+        """
+        for index in batches:
+            self.add(index)
+            yield index
+
+    def evaluate(self):
+        """Returns a summary of every trial added so far, as evaluate_design
+           does.
+        """
+        n, appearances = self.n, self.appearances
+        if len(self.runs) > 1:
+            self.runs   = [ merge_pair_counts(self.runs) ]
+            self.levels = [ max(self.levels) + 1 ]
+        keys, counts  = self.runs[0] if len(self.runs) > 0 else (np.zeros(0, dtype=np.int64),) * 2
+        histogram     = np.bincount(counts) if len(counts) > 0 else np.zeros(1, dtype=np.int64)
+        histogram[0]  = n * (n - 1) // 2 - len(keys)
+        components    = int((self.parent == np.arange(n)).sum())
+        return { "items"            : n,
+                 "trials"           : self.trials,
+                 "K"                : self.K,
+                 "appearances_min"  : int(appearances.min()) if n > 0 else 0,
+                 "appearances_max"  : int(appearances.max()) if n > 0 else 0,
+                 "appearances_mean" : float(appearances.mean()) if n > 0 else 0.0,
+                 "appearances_sd"   : float(appearances.std()) if n > 0 else 0.0,
+                 "unshown_items"    : int((appearances == 0).sum()),
+                 "duplicate_trials" : self.duplicates,
+                 "pair_histogram"   : { i : int(c) for i, c in enumerate(histogram) if c > 0 },
+                 "distinct_pairs"   : int(len(keys)),
+                 "repeated_pairs"   : int((counts - 1).sum()),
+                 "components"       : components,
+                 "connected"        : components == 1 }
+
+
+
+################################################################################
+# SUPPORT FUNCTIONS
+################################################################################
+def generator_rng():
+    """Returns a NumPy random generator seeded from the random module, so that
+       random.seed() also makes the vectorised generators reproducible.
+    """
+    return np.random.default_rng(random.getrandbits(64))
+
+def has_duplicates(index):
+    """Returns a boolean array marking the rows of a trial index matrix that
+       contain the same item more than once.
+    """
+    K   = index.shape[1]
+    dup = np.zeros(len(index), dtype=bool)
+    for i, j in itertools.combinations(range(K), 2):
+        dup |= index[:,i] == index[:,j]
+    return dup
+
+def draw_allowed(n, forbidden, rng):
+    """Draws an item uniformly at random from the n items, other than those
+       in the set forbidden, by drawing a rank among the allowed items and
+       stepping it past each forbidden item at or below it. Returns None if
+       every item is forbidden.
+    """
+    if len(forbidden) >= n:
+        return None
+    item = int(rng.integers(n - len(forbidden)))
+    for other in sorted(forbidden):
+        if other > item:
+            break
+        item += 1
+    return item
 
-       ensures any 2 pairs of items do not repeat, and that each item appears
-       an equal number of times.
+def exclusion_index(exclude):
+    """Returns exclude, or None if it excludes nothing, so that generators
+       only pay for checking exclusions when there are some.
+    """
+    if exclude != None and len(exclude) == 0:
+        return None
+    return exclude
+
+def read_exclusions(file, items, sep=None):
+    """Reads groups of items that must never appear in a trial together from
+       a text file with one group per line, its items separated by sep (tab
+       for .tsv files, and comma for all else, by default). Returns a tuple of
+       an ExclusionIndex over items, and a list of any named items that are
+       not among items.
+    """
+    if sep == None:
+        sep = infer_sep(file)
+    ids     = { item : i for i, item in enumerate(items) }
+    groups  = [ ]
+    unknown = [ ]
+    with open_text(file, newline="") as f:
+        for row in csv.reader(f, delimiter=sep):
+            group = [ cell.strip() for cell in row if len(cell.strip()) > 0 ]
+            unknown.extend(item for item in group if item not in ids)
+            groups.append([ ids[item] for item in group if item in ids ])
+    return ExclusionIndex.from_groups(len(items), groups), unknown
+
+def index_to_trials(items, index):
+    """Converts a trial index matrix into a list of trials, each a list of
+       items.
+    """
+    labels    = np.empty(len(items), dtype=object)
+    labels[:] = list(items)
+    return labels[index].tolist()
+
+def collect_index(batches, K):
+    """Stacks batches of trials from one of the iter_index_* generators into
+       a single (N, K) index matrix.
+    """
+    batches = list(batches)
+    if len(batches) == 0:
+        return np.zeros((0, K), dtype=np.int32)
+    return np.concatenate(batches)
 
-       This is the suggested algorithm to use, unless you have a very large
-       dataset (10k+ items). Then, reduce the restriction of repeating bigrams
-       for computational efficiency and run build_trials_even.
+def write_trials(f, items, batches, K, sep=","):
+    """Writes a design to the text file f, as a header (option1, ...,
+       optionK) followed by one row per trial. batches are index matrices,
+       as yielded by the iter_index_* generators, and are written one at a
+       time with a single write each, so the whole design is never held in
+       memory. Returns the number of trials written.
     """
-    items_orig = [w for w in items]
-    if (N * K) % len(items) != 0:
+    labels    = np.empty(len(items), dtype=object)
+    labels[:] = [ str(item) for item in items ]
+    f.write(sep.join([ "option%d" % (i+1) for i in range(K) ]) + "\n")
+    written   = 0
+    for batch in batches:
+        f.write("".join([ sep.join(row) + "\n" for row in labels[batch].tolist() ]))
+        written += len(batch)
+    return written
+
+
+
+################################################################################
+# GENERATORS
+################################################################################
+def iter_index_even_bigram_norepeat(n, N=1, K=4, tries=NOREPEAT_TRIES,
+                                    backtracks=NOREPEAT_BACKTRACKS, batch=TRIAL_BATCH,
+                                    stats=None, exclude=None):
+    """Builds N trials with K items each, from n items, yielding them in (up
+       to batch, K) int32 matrices of item indices.
+
+       Ensures each item appears an equal number of times, and that no pair
+       of items appears together in more than one trial, so far as possible.
+
+       Trials are built one at a time from a shuffled pool holding the
+       appearances still owed by each item, topped up with another shuffled
+       copy of the items whenever it runs low. Each slot of a trial is filled
+       with the first of up to `tries` items from the pool that has not yet
+       been paired with anything already in the trial. If none fits, the
+       trial is restarted from a random new first item, up to `backtracks`
+       times, after which the items that repeat the fewest pairs are accepted
+       instead. Repeats are only ever needed near the end of the design, when
+       the pool is nearly empty. If stats is a dictionary, the number of
+       repeated pairs accepted is stored in stats["repeats"] once every trial
+       has been yielded.
+
+       If exclude is an ExclusionIndex, items are never placed in a trial
+       with an item they are excluded from, even where a repeat is accepted.
+
+       This is the suggested algorithm to use. It scales to large datasets
+       (100k+ items).
+    """
+    if n < K:
+        raise Exception("Need at least K items to build trials.")
+    if (N * K) % n != 0:
         raise Exception("For an even design, trials * K MOD items must equal 0.")
-    trials_per_batch = len(items) // K
-    batches          = N // trials_per_batch
-    trials           = [ ]
-    pairs            = set()
-    
-    for i in range(batches):
-        items = [ w for w in items_orig ]
-        random.shuffle(items)
-
-        fails = 0
-        while len(items) > 0:
-            trial  = tuple(items[:K])
-            combos = [ c for c in itertools.combinations(trial, 2) ]
-            unique = sum([p in pairs for p in combos]) == 0
-
-            if unique == True or fails >= 20:
-                for c in combos:
-                    pairs.add(c)
-                trials.append(list(trial))
-                items = items[K:]
-                fails = 0
-            else:
-                random.shuffle(items)
-                fails += 1
-    return trials
-
-def build_trials_even(items, N=1, K=4):
+    refills  = (N * K) // n
+    pairs    = PairIndex(n, capacity=N * K * (K - 1) // 2)
+    exclude  = exclusion_index(exclude)
+    trials   = [ ]
+    repeats  = { }     # packed pair -> appearances beyond the first
+    pool     = [ ]
+    ids      = list(range(n))
+    built    = 0
+
+    while built < N:
+        # top up the pool. New items go underneath what is left, which is
+        # used first; keeping a few trials' worth of items in the pool leaves
+        # room to avoid repeats until the last copy is used up.
+        if len(pool) < 4 * K and refills > 0:
+            copy = ids[:]
+            random.shuffle(copy)
+            pool = copy + pool
+            refills -= 1
+            continue
+
+        # build the trial at the end of the pool, by swapping suitable items
+        # into place from further down
+        top = len(pool) - 1
+        for attempt in range(backtracks + 2):
+            allow_repeats = attempt > backtracks
+            if attempt > 0:
+                i = random.randrange(len(pool))
+                pool[top], pool[i] = pool[i], pool[top]
+
+            size = 1
+            while size < K:
+                slot  = top - size
+                trial = pool[slot+1:]
+                best, fewest = None, K
+                for i in range(slot, max(-1, slot - tries), -1):
+                    item = pool[i]
+                    if item in trial:
+                        continue
+                    if exclude != None and exclude.conflicts(item, trial):
+                        continue
+                    if pairs.isdisjoint(item, trial):
+                        best, fewest = i, 0
+                        break
+                    conflicts = pairs.count(item, trial)
+                    if conflicts < fewest:
+                        best, fewest = i, conflicts
+                if best == None or (fewest > 0 and allow_repeats == False):
+                    break
+                pool[slot], pool[best] = pool[best], pool[slot]
+                size += 1
+            if size == K:
+                break
+
+        # the pool may end on several copies of one item (or on items that
+        # are excluded from each other), too few for a trial. Swap the extra
+        # copies into earlier trials that have not been yielded yet.
+        swaps = 0
+        while size < K:
+            slot  = top - size
+            trial = pool[slot+1:]
+            if len(trials) == 0 or swaps > NOREPEAT_ATTEMPTS * n:
+                raise Exception("Could not build trials of %d items without showing excluded items together." % K)
+            swap  = random.choice(trials)
+            j     = random.randrange(K)
+            swaps += 1
+            if pool[slot] in swap or swap[j] in trial:
+                continue
+            if exclude != None and (exclude.conflicts(swap[j], trial) or
+                                    exclude.conflicts(pool[slot], swap[:j] + swap[j+1:])):
+                continue
+            # the item swapped out of the earlier trial leaves its pairs there
+            for other in swap[:j] + swap[j+1:]:
+                key = pairs.key(swap[j], other)
+                if repeats.get(key, 0) > 0:
+                    repeats[key] -= 1
+                else:
+                    pairs.discard(key)
+            swap[j], pool[slot] = pool[slot], swap[j]
+            pairs.add([ (swap[j], other) for other in swap if other != swap[j] ], repeats)
+            size += 1
+
+        # take the trial off the pool, and record its pairings
+        trial = pool[-K:]
+        del pool[-K:]
+        pairs.add(itertools.combinations(trial, 2), repeats)
+        trials.append(trial)
+        built += 1
+
+        # yield trials a batch at a time, but keep a batch back for repairs
+        if len(trials) >= 2 * batch:
+            yield np.array(trials[:batch], dtype=np.int32)
+            del trials[:batch]
+
+    if stats != None:
+        stats["repeats"] = sum(repeats.values())
+    if len(trials) > 0:
+        yield np.array(trials, dtype=np.int32)
+
+def build_trials_even_bigram_norepeat(items, N=1, K=4, tries=NOREPEAT_TRIES,
+                                      backtracks=NOREPEAT_BACKTRACKS, stats=None, exclude=None):
     """Builds N trials with K items each.
 
-       Ensures each item appears an equal number of times.
+       Ensures each item appears an equal number of times, and that no pair
+       of items appears together in more than one trial, so far as possible.
+       See iter_index_even_bigram_norepeat.
     """
-    if (N * K) % len(items) != 0:
+    items = list(items)
+    return index_to_trials(items, collect_index(iter_index_even_bigram_norepeat(len(items), N=N, K=K,
+                           tries=tries, backtracks=backtracks, stats=stats, exclude=exclude), K))
+
+def build_index_even(n, N=1, K=4, rng=None, exclude=None):
+    """Builds N trials with K items each, from n items, as an (N, K) int32
+       matrix of item indices.
+
+       Ensures each item appears an equal number of times. Trials are cut
+       from back-to-back random permutations of the items, all drawn at once.
+       If n is not a multiple of K, a trial may straddle two permutations and
+       draw the same item twice; such items are swapped with other trials.
+       So are items that exclude (an ExclusionIndex) keeps from appearing
+       with others in their trial.
+    """
+    if (N * K) % n != 0:
         raise Exception("For an even design, trials * K % items must equal 0.")
-    trials_per_batch = len(items) // K
-    batches          = N // trials_per_batch
-    trials  = [ ]
-    for i in range(batches):
-        items_copy = [ w for w in items ]
-        random.shuffle(items_copy)
-        while len(items_copy) > 0:
-            trials.append(items_copy[:K])
-            items_copy = items_copy[K:]
-    return trials
-
-def build_trials_random(items, N=1, K=4):
+    if n < K:
+        raise Exception("Need at least K items to build trials.")
+    if rng is None:
+        rng = generator_rng()
+    batches = (N * K) // n
+    order   = np.tile(np.arange(n, dtype=np.int32), (batches, 1))
+    index   = rng.permuted(order, axis=1, out=order).reshape(N, K)
+    exclude = exclusion_index(exclude)
+
+    if n % K == 0 and exclude == None:
+        return index
+    bad = has_duplicates(index)
+    if exclude != None:
+        bad |= exclude.conflicting(index)
+    for row in np.flatnonzero(bad):
+        for j in range(1, K):
+            swaps = 0
+            while index[row,j] in index[row,:j] or (exclude != None and
+                                                    exclude.conflicts(index[row,j], index[row,:j].tolist())):
+                if swaps > NOREPEAT_ATTEMPTS * n:
+                    raise Exception("Could not build trials of %d items without showing excluded items together." % K)
+                swaps += 1
+                other, col = rng.integers(N), rng.integers(K)
+                if index[other,col] in index[row] or index[row,j] in index[other]:
+                    continue
+                if exclude != None and (exclude.conflicts(index[other,col], index[row,:j].tolist()) or
+                                        exclude.conflicts(index[row,j], np.delete(index[other], col).tolist())):
+                    continue
+                index[row,j], index[other,col] = index[other,col], index[row,j]
+    return index
+
+def build_index_random(n, N=1, K=4, rng=None, exclude=None):
+    """Builds N trials with K items each, from n items, as an (N, K) int32
+       matrix of item indices.
+
+       Items are randomly pulled for each trial, without replacement within
+       a trial. Every trial is drawn at once, and the few that draw an item
+       twice are drawn again. If exclude (an ExclusionIndex) is given, the
+       trials that pair excluded items are then rebuilt one item at a time
+       (see draw_allowed): each item after the first is drawn from those not
+       already in the trial, nor excluded from any item in it. A trial is
+       restarted from a new first item if none are left, and an exception
+       raised if that keeps happening.
+    """
+    if n < K:
+        raise Exception("Need at least K items to build trials.")
+    if rng is None:
+        rng = generator_rng()
+    exclude = exclusion_index(exclude)
+
+    # with few items to choose from, take the first K of a random ordering
+    if n <= 4 * K:
+        index = np.argsort(rng.random((N, n)), axis=1)[:,:K].astype(np.int32)
+    else:
+        index = rng.integers(0, n, size=(N, K), dtype=np.int32)
+        redo  = np.flatnonzero(has_duplicates(index))
+        while len(redo) > 0:
+            index[redo] = rng.integers(0, n, size=(len(redo), K), dtype=np.int32)
+            redo        = redo[has_duplicates(index[redo])]
+    if exclude == None:
+        return index
+
+    for row in np.flatnonzero(exclude.conflicting(index)):
+        for attempt in range(NOREPEAT_ATTEMPTS):
+            trial = [ int(rng.integers(n)) ]
+            while len(trial) < K:
+                item = draw_allowed(n, exclude.excluded(trial).union(trial), rng)
+                if item == None:
+                    break
+                trial.append(item)
+            if len(trial) == K:
+                break
+        else:
+            raise Exception("Could not build trials of %d items without showing excluded items together." % K)
+        index[row] = trial
+    return index
+
+def iter_index_even(n, N=1, K=4, batch=TRIAL_BATCH, rng=None, exclude=None):
+    """Builds the same design as build_index_even, but yields it in index
+       matrices of roughly batch trials each. Each is made of whole
+       permutations of the items, so every item still appears an equal
+       number of times overall.
+    """
+    if (N * K) % n != 0:
+        raise Exception("For an even design, trials * K % items must equal 0.")
+    if rng is None:
+        rng = generator_rng()
+
+    # permutations per matrix; a multiple of step fills whole trials
+    step      = K // math.gcd(n, K)
+    per       = max(step, (batch * K // n) // step * step)
+    remaining = (N * K) // n
+    while remaining > 0:
+        perms = min(per, remaining)
+        yield build_index_even(n, N=perms * n // K, K=K, rng=rng, exclude=exclude)
+        remaining -= perms
+
+def iter_index_random(n, N=1, K=4, batch=TRIAL_BATCH, rng=None, exclude=None):
+    """Builds the same design as build_index_random, but yields it in index
+       matrices of up to batch trials each.
+    """
+    if rng is None:
+        rng = generator_rng()
+    for start in range(0, N, batch):
+        yield build_index_random(n, N=min(batch, N - start), K=K, rng=rng, exclude=exclude)
+
+def build_trials_even(items, N=1, K=4, exclude=None):
     """Builds N trials with K items each.
 
-       Items are randomly pulled for each trial.
+       Ensures each item appears an equal number of times. See
+       build_index_even.
     """
-    trials = [ ]
-    for i in range(N):
-        trials.append(random.sample(items,K))
-    return trials
+    return index_to_trials(items, build_index_even(len(items), N=N, K=K, exclude=exclude))
 
-def build_trials_random_bigram_norepeat(items, N=1, K=4):
+def build_trials_random(items, N=1, K=4, exclude=None):
     """Builds N trials with K items each.
 
+       Items are randomly pulled for each trial. See build_index_random.
+    """
+    return index_to_trials(items, build_index_random(len(items), N=N, K=K, exclude=exclude))
+
+def max_norepeat_trials(n, K):
+    """Returns an upper bound on the number of trials of K items that can be
+       built from n items without any pair of items appearing together twice.
+       Each item has n-1 possible partners and meets K-1 of them per trial,
+       so it can appear in at most (n-1) // (K-1) trials.
+    """
+    if K < 2:
+        return float("inf")
+    return (n * ((n - 1) // (K - 1))) // K
+
+def iter_index_random_bigram_norepeat(n, N=1, K=4, tries=NOREPEAT_TRIES,
+                                      max_attempts=None, time_limit=None,
+                                      progress=None, batch=TRIAL_BATCH, stats=None,
+                                      exclude=None):
+    """Builds N trials with K items each, from n items, yielding them in (up
+       to batch, K) int32 matrices of item indices.
+
        ensures any 2 pairs of items do not repeat, but items are randomly
        selected with no guarantee of an even number of appearances of each
        item. 
+
+       Each trial is built one item at a time, drawing each new item at
+       random from those not yet paired with anything already in the trial.
+       While few pairs are used, up to `tries` random items are simply
+       checked against an index of the pairs used so far; past that, the
+       compatible items are listed outright. A trial that runs out of
+       compatible items is abandoned and started over. If exclude is an
+       ExclusionIndex, items it excludes from anything already in the trial
+       are never compatible.
+
+       Raises an exception up front if N trials cannot possibly be built
+       (see max_norepeat_trials). Otherwise, generation stops early, with the
+       trials built so far, once NOREPEAT_STREAK trials in a row have been
+       abandoned, max_attempts trials have been abandoned in all (no limit
+       by default), or time_limit seconds have passed. If progress is
+       supplied, it is called as progress(built, N, abandoned) every
+       PROGRESS_EVERY trials built or abandoned. If stats is a dictionary,
+       stats["abandoned"] is set to the number of abandoned trials, and
+       stats["complete"] to whether all N trials were built, once every trial
+       has been yielded.
     """
-    pairs = set()
+    if n < K:
+        raise Exception("Need at least K items to build trials.")
+    if N > max_norepeat_trials(n, K):
+        raise Exception("Cannot build %d trials of %d items from %d items without repeating pairs. At most %d are possible." % (N, K, n, max_norepeat_trials(n, K)))
+    if max_attempts == None:
+        max_attempts = float("inf")
+    deadline  = None if time_limit == None else time.monotonic() + time_limit
+    pairs     = PairIndex(n, capacity=N * K * (K - 1) // 2)
+    exclude   = exclusion_index(exclude)
+    trials    = [ ]
+    abandoned = 0
+    streak    = 0
+    built     = 0
+    randrange = random.randrange
+
+    while built < N and abandoned <= max_attempts and streak < NOREPEAT_STREAK:
+        if deadline != None and time.monotonic() > deadline:
+            break
+
+        trial = [ randrange(n) ]
+        while len(trial) < K:
+            # first try a few items at random
+            item = None
+            for i in range(tries):
+                candidate = randrange(n)
+                if candidate not in trial and pairs.isdisjoint(candidate, trial):
+                    if exclude == None or not exclude.conflicts(candidate, trial):
+                        item = candidate
+                        break
+
+            # otherwise, list every item that is still compatible
+            if item == None:
+                compatible = pairs.compatible(trial)
+                if exclude != None:
+                    excluded   = np.fromiter(exclude.excluded(trial), dtype=np.int64)
+                    compatible = compatible[~np.isin(compatible, excluded)]
+                if len(compatible) == 0:
+                    break
+                item = int(compatible[randrange(len(compatible))])
+            trial.append(item)
+
+        if len(trial) < K:
+            abandoned += 1
+            streak    += 1
+            if progress != None and abandoned % PROGRESS_EVERY == 0:
+                progress(built, N, abandoned)
+            continue
+
+        pairs.add(itertools.combinations(trial, 2))
+        trials.append(trial)
+        built += 1
+        streak = 0
+        if progress != None and built % PROGRESS_EVERY == 0:
+            progress(built, N, abandoned)
+        if len(trials) == batch:
+            yield np.array(trials, dtype=np.int32)
+            trials = [ ]
+
+    if stats != None:
+        stats["abandoned"] = abandoned
+        stats["complete"]  = built == N
+    if len(trials) > 0:
+        yield np.array(trials, dtype=np.int32)
+
+def build_trials_random_bigram_norepeat(items, N=1, K=4, tries=NOREPEAT_TRIES,
+                                        max_attempts=None, time_limit=None,
+                                        progress=None, stats=None, exclude=None):
+    """Builds N trials with K items each.
+
+       ensures any 2 pairs of items do not repeat, but items are randomly
+       selected with no guarantee of an even number of appearances of each
+       item. See iter_index_random_bigram_norepeat.
+    """
+    items = list(items)
+    return index_to_trials(items, collect_index(iter_index_random_bigram_norepeat(len(items), N=N, K=K,
+                           tries=tries, max_attempts=max_attempts, time_limit=time_limit,
+                           progress=progress, stats=stats, exclude=exclude), K))
+
+def cyclic_base_blocks(n, K, blocks, short=False):
+    """Searches for base blocks of a cyclic design over the integers mod n:
+       `blocks` sets of K residues each, such that no difference between
+       two residues of a block (up to sign) occurs twice across all of them.
+       Each block is grown greedily from 0, taking the smallest residue whose
+       differences are all still unused. If short is True, the short block
+       {0, n/K, 2n/K, ...} is reserved first (n must be a multiple of K).
+
+       Returns a tuple of (blocks, short block or None), or None if the
+       search runs out of residues.
+    """
+    def canon(d):
+        d %= n
+        return min(d, n - d)
+
+    used, short_block = set(), None
+    if short == True:
+        if n % K != 0:
+            return None
+        short_block = [ j * (n // K) for j in range(K) ]
+        used.update(canon(j * (n // K)) for j in range(1, K))
+
+    base = [ ]
+    for b in range(blocks):
+        block, x = [ 0 ], 1
+        while len(block) < K:
+            if x >= n:
+                return None
+            diffs = [ canon(x - y) for y in block ]
+            # n/2 would pair each item with its opposite twice per block
+            if len(set(diffs)) == len(diffs) and not any(d in used or 2 * d == n for d in diffs):
+                block.append(x)
+                used.update(diffs)
+            x += 1
+        base.append(block)
+    return base, short_block
+
+def build_index_cyclic(n, N=1, K=4):
+    """Builds N trials with K items each, from n items, as an (N, K) int32
+       matrix of item indices, by developing base blocks mod n (see
+       cyclic_base_blocks): each base block B yields the n trials B + x, for
+       x = 0 ... n-1. Because no difference repeats across base blocks, no
+       pair of items appears together twice, and every item appears equally
+       often in every position of a trial.
+
+       A design of N trials needs N / n full base blocks, plus a short block
+       (n / K trials) if N is an odd multiple of n / K. Any other remainder
+       of trials is taken from one more base block, developed over evenly
+       spaced shifts only; items then appear up to K times more or less
+       often than one another, instead of equally often. Returns None if
+       there is no such design, or none can be found.
+    """
+    if n < K:
+        return None
+    blocks, extra = divmod(N, n)
+    short   = extra != 0 and n % K == 0 and extra == n // K
+    partial = extra != 0 and not short
+    if (blocks + partial) * (K * (K - 1) // 2) + (K - 1) * short > (n - 1) // 2:
+        return None
+    found = cyclic_base_blocks(n, K, blocks + partial, short=short)
+    if found == None:
+        return None
+    base, short_block = found
+
+    parts  = [ ]
+    shifts = np.arange(n, dtype=np.int64)
+    if partial:
+        last = base.pop()
+        parts.append((np.array(last)[None,:] + ((shifts[:extra] * n) // extra)[:,None]) % n)
+    if len(base) > 0:
+        parts.append(((np.array(base)[:,None,:] + shifts[None,:,None]) % n).reshape(-1, K))
+    if short_block != None:
+        parts.append((np.array(short_block)[None,:] + shifts[:n // K,None]) % n)
+    return np.concatenate(parts).astype(np.int32)
+
+def build_index_padded(n, N=1, K=4, rng=None, stats=None):
+    """Builds N trials with K items each, from n items, as an (N, K) int32
+       matrix of item indices, from a cyclic design over m > n items (see
+       build_index_cyclic), for when none can be found over n itself. The
+       m - n extra items are dummies: they are placed at random, and every
+       trial that contains one is dropped. Each item meets each dummy at
+       most once, so it loses at most one trial per dummy, and no pair of
+       items appears together twice. At most BIBD_DUMMIES * K dummies are
+       used, the fewest that work; the design over m items is made just
+       large enough to leave N trials, and any left over are dropped at
+       random. If stats is a dictionary, stats["dummies"] is set to m - n.
+
+       Returns None if no such design is found.
+    """
+    if rng is None:
+        rng = generator_rng()
+    if K < 2 or n < K:
+        return None
+    for m in range(n + 1, n + BIBD_DUMMIES * K + 1):
+        # each dummy takes about N * K / n trials with it
+        size = -(-N * m // max(m - (m - n) * K, 1))
+        for attempt in range(K):
+            index = build_index_cyclic(m, N=size, K=K)
+            if index is None:
+                break
+            index = rng.permutation(m)[index]
+            index = index[(index < n).all(axis=1)]
+            if len(index) >= N:
+                if stats != None:
+                    stats["dummies"] = m - n
+                return index[np.sort(rng.permutation(len(index))[:N])].astype(np.int32)
+            size += len(index) - N + K
+    return None
+
+def relabel_design(design, n, rng, exclude=None, tries=NOREPEAT_TRIES):
+    """Returns a copy of a trial index matrix over n items with the items
+       relabelled at random. Relabelling keeps every property of a design
+       that does not depend on which item is which: balance, and repeated
+       pairs. If exclude (an ExclusionIndex) is given, every excluded pair
+       must also land on a pair the design never shows together; items with
+       an excluded partner they clash with are swapped with up to `tries`
+       random items each, keeping any swap that leaves fewer clashes, until
+       none remain. Returns None if they cannot all be resolved.
+    """
+    label = rng.permutation(n)
+    if exclude == None:
+        return label.astype(np.int32)[design]
+
+    # slot[item] is the design position that item is given
+    covered, _ = count_pairs(design, n)
+    slot       = np.empty(n, dtype=np.int64)
+    slot[label] = np.arange(n)
+    shown      = lambda u, v: covered[min(np.searchsorted(covered, min(u, v) * n + max(u, v)),
+                                          len(covered) - 1)] == min(u, v) * n + max(u, v)
+    clashes    = lambda item: sum(shown(slot[item], slot[other]) for other in exclude.adjacent.get(item, ()))
+
+    pending = [ item for item in exclude.adjacent if clashes(item) > 0 ]
+    moves   = 0
+    while len(pending) > 0:
+        item = pending.pop()
+        if clashes(item) == 0:
+            continue
+        for attempt in range(tries):
+            other  = int(rng.integers(n))
+            before = clashes(item) + clashes(other)
+            slot[item], slot[other] = slot[other], slot[item]
+            if clashes(item) + clashes(other) < before:
+                break
+            slot[item], slot[other] = slot[other], slot[item]
+        else:
+            return None
+        moves += 1
+        if moves > NOREPEAT_ATTEMPTS * len(exclude):
+            return None
+        pending.extend(x for x in (item, other) if clashes(x) > 0)
+
+    label[slot] = np.arange(n)
+    return label.astype(np.int32)[design]
+
+def iter_index_bibd(n, N=1, K=4, batch=TRIAL_BATCH, rng=None, stats=None, exclude=None):
+    """Builds N trials with K items each, from n items, yielding them in (up
+       to batch, K) int32 matrices of item indices.
+
+       Where possible, the design is constructed outright as a cyclic design
+       (see build_index_cyclic), with no repeated pairs and every item
+       appearing an equal or near-equal number of times. Where none can be
+       found over n items, one over a few more is built and the dummy items'
+       trials dropped (see build_index_padded). If N is more than n items
+       can fill without repeating pairs (see max_norepeat_trials), the trials
+       are split into as few equal copies as fit, each built this way, so
+       that pairs repeat only across copies. Items are relabelled at random
+       in every copy, and the trials shuffled, so that the structure does not
+       follow the order of the items; if exclude (an ExclusionIndex) is
+       given, the relabelling also keeps excluded pairs apart (see
+       relabel_design).
+
+       Failing all of that, trials come from iter_index_even_bigram_norepeat.
+       If stats is a dictionary, stats["construction"] is set to "cyclic",
+       "padded", or "greedy"; stats["copies"] to the number of copies, and
+       stats["dummies"] to the most dummy items a padded copy used, along
+       with stats["repeats"], or any stats from the greedy generator.
+    """
+    if rng is None:
+        rng = generator_rng()
+    exclude = exclusion_index(exclude)
+
+    if N == 0:
+        if stats != None:
+            stats["construction"], stats["copies"], stats["repeats"] = "cyclic", 0, 0
+        return
 
-    trials = [ ]
-    while len(trials) < N:
-        sample = tuple(random.sample(items, K))
+    # every copy needs at least one trial
+    fewest = 1
+    if N > max_norepeat_trials(n, K) and max_norepeat_trials(n, K) > 0:
+        fewest = -(-N // max_norepeat_trials(n, K))
+    for copies in range(fewest, min(N, fewest + (BIBD_COPIES if fewest > 1 else 0)) + 1):
+        construction, dummies, parts = "cyclic", 0, [ ]
+        for c in range(copies):
+            size  = N // copies + (c < N % copies)
+            index = build_index_cyclic(n, N=size, K=K)
+            if index is None:
+                padding = { }
+                index   = build_index_padded(n, N=size, K=K, rng=rng, stats=padding)
+                if index is not None:
+                    construction = "padded"
+                    dummies      = max(dummies, padding["dummies"])
+            if index is not None:
+                index = relabel_design(index, n, rng, exclude=exclude)
+            if index is None:
+                parts = None
+                break
+            parts.append(index)
+        if parts is not None:
+            break
 
-        # build the pairlist
-        combos = [c for c in itertools.combinations(sample, 2) ]
-        unique = sum([p in pairs for p in combos]) == 0
+    if parts is None:
+        if stats != None:
+            stats["construction"] = "greedy"
+        for part in iter_index_even_bigram_norepeat(n, N=N, K=K, batch=batch, stats=stats,
+                                                    exclude=exclude):
+            yield part
+        return
 
-        if unique == True:
-            trials.append(list(sample))
-            for c in combos:
-                pairs.add(c)
-    return trials
+    index = np.concatenate(parts)
+    if stats != None:
+        stats["construction"] = construction
+        stats["copies"]       = copies
+        stats["repeats"]      = 0
+        if construction == "padded":
+            stats["dummies"] = dummies
+        if copies > 1:
+            pairs, counts = count_pairs(index, n)
+            stats["repeats"] = int((counts - 1).sum())
+    index = index[rng.permutation(len(index))]
+    for start in range(0, len(index), batch):
+        yield index[start:start+batch]
 
-def build_trials_semirandom(items, N=1, K=4, even_pct=0.5):
+def build_trials_bibd(items, N=1, K=4, stats=None, exclude=None):
+    """Builds N trials with K items each.
+
+       Ensures each item appears an equal number of times, and that no pair
+       of items appears together twice, by construction where possible. See
+       iter_index_bibd.
+    """
+    items = list(items)
+    return index_to_trials(items, collect_index(iter_index_bibd(len(items), N=N, K=K, stats=stats,
+                                                                exclude=exclude), K))
+
+def iter_index_adaptive(scores, uncertainty, N=1, K=4, max_exposure=None, spread=ADAPTIVE_SPREAD,
+                        batch=TRIAL_BATCH, rng=None, stats=None, exclude=None):
+    """Builds the next N trials with K items each, given each item's current
+       score and the uncertainty of that score (e.g., its standard error; see
+       scoring.score_uncertainty), yielding them in (up to batch, K) int32
+       matrices of item indices. Items that have not been scored yet may be
+       given a score of nan, and are then treated as the most uncertain items,
+       with a score in the middle of the range.
+
+       The first item of each trial is drawn with probability proportional to
+       its uncertainty. The rest are drawn, without replacement and again
+       weighted by uncertainty, from the items scored within `spread` times
+       that uncertainty of it (and at least its K - 1 nearest neighbours
+       either side, in score order): the items it could plausibly trade
+       places with. If exclude is an ExclusionIndex, candidates excluded from
+       the first item are passed over, and trials that still pair excluded
+       items are dropped. The last ADAPTIVE_EXPLORE items of each trial are
+       instead drawn at random from the items shown least so far this round,
+       whatever their scores, so that the round reaches every item and the
+       trials do not split into separate groups around each score region.
+
+       No item is shown more than max_exposure times; by default, ADAPTIVE_SLACK
+       times as often as in an even design. Trials are drawn in rounds of
+       about one appearance per item; trials that would take an item over its
+       limit are dropped, and if a round keeps none, the spread is doubled.
+       If stats is a dictionary, stats["complete"] is set to False if the
+       limits left too few items to build all N trials.
+    """
+    scores      = np.asarray(scores, dtype=np.float64)
+    uncertainty = np.asarray(uncertainty, dtype=np.float64)
+    n           = len(scores)
+    if K > n:
+        raise Exception("Cannot build trials of %d items from only %d items." % (K, n))
+    if rng is None:
+        rng = generator_rng()
+    if max_exposure == None:
+        max_exposure = max(1, int(math.ceil(ADAPTIVE_SLACK * N * K / n)))
+
+    # unscored items sit mid-range, and are the most uncertain of all
+    unseen   = np.isnan(scores) | ~np.isfinite(uncertainty)
+    seen     = uncertainty[~unseen]
+    scores   = np.where(np.isnan(scores), np.nanmedian(scores) if (~np.isnan(scores)).any() else 0.0, scores)
+    top      = seen.max() if len(seen) > 0 and seen.max() > 0 else 1.0
+    priority = np.where(unseen, 2.0 * top, np.maximum(uncertainty, 1e-3 * top))
+
+    order    = np.argsort(scores, kind="stable")
+    ranked   = scores[order]
+    rank     = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    draws    = 4 * K
+    exposure = np.zeros(n, dtype=np.int64)
+    exclude  = exclusion_index(exclude)
+
+    built = 0
+    while built < N:
+        avail   = exposure < max_exposure
+        if avail.sum() < K:
+            break
+        weights = np.where(avail, priority, 0.0)
+        size    = min(N - built, batch, max(1, int(avail.sum()) // K))
+
+        # draw first items, then candidates for the rest of each trial from
+        # the ranks around it
+        anchors = rng.choice(n, size=size, p=weights / weights.sum())
+        lo      = np.searchsorted(ranked, scores[anchors] - spread * priority[anchors], side="left")
+        hi      = np.searchsorted(ranked, scores[anchors] + spread * priority[anchors], side="right")
+        lo      = np.minimum(lo, np.maximum(0, rank[anchors] - (K - 1)))
+        hi      = np.maximum(hi, np.minimum(n, rank[anchors] + K))
+        cand    = order[lo[:,None] + (rng.random((size, draws)) * (hi - lo)[:,None]).astype(np.int64)]
+
+        # keep the first item, and fill the trial from the candidates by
+        # weighted sampling without replacement (the Gumbel top-k trick)
+        with np.errstate(divide="ignore"):
+            keys = np.log(weights[cand]) + rng.gumbel(size=cand.shape)
+        srt     = np.argsort(cand, axis=1, kind="stable")
+        dup     = np.zeros(cand.shape, dtype=bool)
+        dup[:,1:] = np.diff(np.take_along_axis(cand, srt, axis=1), axis=1) == 0
+        np.put_along_axis(keys, srt, np.where(dup, -np.inf, np.take_along_axis(keys, srt, axis=1)), axis=1)
+        keys[cand == anchors[:,None]] = -np.inf
+        if exclude != None:
+            keys[exclude.contains(np.minimum(cand, anchors[:,None]) * n + np.maximum(cand, anchors[:,None]))] = -np.inf
+        cand    = np.concatenate([ anchors[:,None], cand ], axis=1)
+        keys    = np.concatenate([ np.full((size, 1), np.inf), keys ], axis=1)
+        local   = K - min(ADAPTIVE_EXPLORE, K - 1)
+        pick    = np.argpartition(-keys, local - 1, axis=1)[:,:local]
+        index   = np.take_along_axis(cand, pick, axis=1)
+        ok      = (np.take_along_axis(keys, pick, axis=1) > -np.inf).all(axis=1)
+
+        # fill the rest with the least-shown available items, in random order
+        if local < K:
+            least   = np.lexsort((rng.random(n), exposure, ~avail))[:int(avail.sum())]
+            extra   = np.resize(least, (size, K - local))
+            ok     &= ~(index[:,:,None] == extra[:,None,:]).any(axis=(1, 2))
+            index   = np.concatenate([ index, extra ], axis=1)
+        if exclude != None:
+            ok &= ~exclude.conflicting(index)
+
+        # count each appearance of an item within the round, in trial order,
+        # and drop trials that would take any of their items over the limit
+        flat    = np.where(ok[:,None], index, n).ravel()
+        srt     = np.argsort(flat, kind="stable")
+        first   = np.r_[True, flat[srt][1:] != flat[srt][:-1]]
+        occur   = np.empty(len(flat), dtype=np.int64)
+        occur[srt] = np.arange(len(flat)) - np.maximum.accumulate(np.where(first, np.arange(len(flat)), 0))
+        ok     &= (exposure[index] + occur.reshape(index.shape) < max_exposure).all(axis=1)
+
+        if not ok.any():
+            if (lo == 0).all() and (hi == n).all():
+                break
+            spread *= 2.0
+            continue
+        index     = rng.permuted(index[ok], axis=1).astype(np.int32)
+        exposure += np.bincount(index.ravel(), minlength=n)
+        built    += len(index)
+        yield index
+
+    if stats != None:
+        stats["complete"] = built >= N
+
+def build_trials_adaptive(items, scores, uncertainty, N=1, K=4, max_exposure=None, stats=None,
+                          exclude=None):
+    """Builds the next N trials with K items each, concentrating on items
+       whose scores are uncertain, and their close-scored neighbours. scores
+       and uncertainty hold one value per item, in the order of items. See
+       iter_index_adaptive.
+    """
+    items = list(items)
+    return index_to_trials(items, collect_index(iter_index_adaptive(scores, uncertainty, N=N, K=K,
+                           max_exposure=max_exposure, stats=stats, exclude=exclude), K))
+
+def build_trials_semirandom(items, N=1, K=4, even_pct=0.5, exclude=None):
     """forces some number of batches to be evenly distributed, but everything
     else is random.
     """
     trials_per_batch = len(items) // K
-    t_even            = build_trials_even(items, int(N * even_pct), K)
-    t_random          = build_trials_random(items, int(N*(1.0 - even_pct)), K)
+    t_even            = build_trials_even(items, int(N * even_pct), K, exclude=exclude)
+    t_random          = build_trials_random(items, int(N*(1.0 - even_pct)), K, exclude=exclude)
     return t_even + t_random
+
+
+
+################################################################################
+# DESIGN EVALUATION
+################################################################################
+def count_pairs(index, n):
+    """Counts how many trials each unordered pair of items appears together
+       in, for a trial index matrix over n items. Returns a tuple of (keys,
+       counts): the pairs that appear at least once, packed as
+       min(a,b) * n + max(a,b), and the number of trials each appears in.
+    """
+    index = np.asarray(index, dtype=np.int64)
+    keys  = [ ]
+    for i, j in itertools.combinations(range(index.shape[1]), 2):
+        a, b = index[:,i], index[:,j]
+        key  = np.minimum(a, b) * n + np.maximum(a, b)
+        keys.append(key[a != b])
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate(keys), return_counts=True)
+
+def join_components(parent, index):
+    """Merges the components of a union-find forest over items (parent, an
+       int64 array of each item's parent; its roots point to themselves) for
+       every trial of a trial index matrix, where items are connected if they
+       appear in a trial together. Returns the updated, fully compressed
+       forest, in which every item points straight at its root.
+
+       Components are merged over every trial's edges at once: each round
+       hooks the root of the larger-numbered item of every edge onto the
+       smaller root, then compresses paths by pointer jumping, until no edge
+       spans two components.
+    """
+    index = np.asarray(index, dtype=np.int64)
+    if index.ndim != 2 or index.shape[1] < 2:
+        return parent
+
+    # a star from the first item of each trial connects the whole trial
+    a = np.repeat(index[:,0], index.shape[1] - 1)
+    b = index[:,1:].ravel()
+    while len(a) > 0:
+        ra, rb = parent[a], parent[b]
+        split  = ra != rb
+        a, b   = a[split], b[split]
+        ra, rb = ra[split], rb[split]
+        np.minimum.at(parent, np.maximum(ra, rb), np.minimum(ra, rb))
+        while True:
+            jumped = parent[parent]
+            if (jumped == parent).all():
+                break
+            parent = jumped
+    return parent
+
+def count_components(index, n):
+    """Returns the number of connected components in the comparison graph of
+       a trial index matrix over n items, where items are connected if they
+       appear in a trial together. Items that never appear are components of
+       their own. See join_components.
+    """
+    parent = join_components(np.arange(n, dtype=np.int64), index)
+    return int((parent == np.arange(n)).sum())
+
+def merge_pair_counts(runs):
+    """Merges (keys, counts) pairs of arrays, as returned by count_pairs,
+       into one, summing the counts of keys that appear in more than one.
+    """
+    keys   = np.concatenate([ run[0] for run in runs ])
+    counts = np.concatenate([ run[1] for run in runs ])
+
+    # a stable sort merges already sorted runs without sorting them afresh
+    order  = np.argsort(keys, kind="stable")
+    keys   = keys[order]
+    if len(keys) == 0:
+        return keys, counts
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(counts[order], starts).astype(np.int64)
+
+def evaluate_design(index, n=None):
+    """Summarizes the quality of a design, given as an (N, K) trial index
+       matrix over n items (by default, one more than the largest index).
+       Returns a dictionary of:
+         items              = number of items, n
+         trials             = number of trials, N
+         K                  = items per trial
+         appearances_min    = fewest trials any item appears in
+         appearances_max    = most trials any item appears in
+         appearances_mean   = mean trials per item
+         appearances_sd     = standard deviation of trials per item
+         unshown_items      = items that never appear
+         duplicate_trials   = trials that show the same item more than once
+         pair_histogram     = dictionary mapping a number of co-occurrences
+                              to the number of pairs of items that appear
+                              together that many times (0 included)
+         distinct_pairs     = pairs of items that appear together at all
+         repeated_pairs     = co-occurrences beyond the first, summed over
+                              pairs
+         components         = connected components of the comparison graph
+         connected          = whether every item is comparable to every other
+
+       To evaluate a design as it is built, a batch at a time, without
+       keeping it, use a DesignTally instead.
+    """
+    index = np.asarray(index)
+    if index.ndim != 2:
+        raise Exception("A design must be an (N, K) matrix of item indices.")
+    if n == None:
+        n = int(index.max()) + 1 if index.size > 0 else 0
+    tally = DesignTally(n, index.shape[1])
+    tally.add(index)
+    return tally.evaluate()
+
+def read_design(file, sep=None):
+    """Reads a design written by create_trials.py (columns option1 ...
+       optionK) back in. Returns a tuple of (items, index), where index is an
+       (N, K) matrix of indices into the list of items, numbered in order of
+       first appearance.
+    """
+    if sep == None:
+        sep = infer_sep(file)
+    with open_text(file, newline='') as f:
+        reader = csv.reader(f, delimiter=sep)
+        header = next(reader, [ ])
+        cols   = [ ]
+        while "option%d" % (len(cols) + 1) in header:
+            cols.append(header.index("option%d" % (len(cols) + 1)))
+        if len(cols) == 0:
+            raise Exception("No option columns (option1, option2, ...) in %s" % file)
+
+        vocab = { }
+        flat  = [ ]
+        for row in reader:
+            if len(row) == 0:
+                continue
+            for i in cols:
+                flat.append(vocab.setdefault(read_cell(row[i]), len(vocab)))
+    index = np.array(flat, dtype=np.int32).reshape(-1, len(cols))
+    return list(vocab.keys()), index
+
+def print_evaluation(report, out=sys.stdout):
+    """Prints a report from evaluate_design as two-column CSV.
+    """
+    out.write("Measure,Value\n")
+    for key in ("items", "trials", "K", "appearances_min", "appearances_max", "appearances_mean",
+                "appearances_sd", "unshown_items", "duplicate_trials", "distinct_pairs",
+                "repeated_pairs", "components", "connected"):
+        out.write("%s,%s\n" % (key, str(report[key])))
+    for times, pairs in sorted(report["pair_histogram"].items()):
+        out.write("pairs_seen_%d_times,%d\n" % (times, pairs))
+
+
+
+################################################################################
+# MAIN
+################################################################################
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Tools for best-worst trial designs.')
+    commands = parser.add_subparsers(dest="command")
+
+    evaluate = commands.add_parser("evaluate", help="Summarize the balance, pair repeats, and connectivity of a design made by create_trials.py.")
+    evaluate.add_argument("input", type=str, help="Path to a design (columns option1 ... optionK).")
+    evaluate.add_argument("--sep", type=str, default=None, help="Specify the column separator. If None specified, use default (tab for .tsv, also when compressed as .tsv.gz etc., comma for all else)")
+
+    args = parser.parse_args(argv)
+    if args.command == "evaluate":
+        items, index = read_design(args.input, sep=args.sep)
+        print_evaluation(evaluate_design(index, n=len(items)))
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    sys.exit(main())
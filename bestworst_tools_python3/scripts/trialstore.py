@@ -0,0 +1,457 @@
+"""
+trialstore.py
+
+A compact, binary file format for best-worst trials, so that data only has to
+be parsed from CSV once. A trial store (.bwt) holds the item vocabulary, plus
+the trials themselves as integer arrays:
+
+  options      = (n_trials, K) int32 matrix of the items in each trial's
+                 option columns (option1 ... optionK), in order. Trials with
+                 fewer than K options are padded with -1.
+  best, worst  = int32 index of the best and worst item in each trial
+  participant  = optional int32 participant id for each trial, with its own
+                 vocabulary of participant labels
+  group        = optional int32 group id for each trial, likewise
+
+The file is a short JSON header followed by the raw arrays, each aligned to 64
+bytes, so that loading a store memory-maps the arrays without copying them.
+
+To convert CSV data to a trial store:
+
+  python3 scripts/trialstore.py convert samples/aoa_raw_data/* --out=aoa.bwt
+
+Wherever a trial file is accepted (score_trials.py, flag_noncompliant_users.py,
+the Streamlit scorer), a .bwt store can be used instead.
+
+This software is released under the Creative Commons licence:
+  Attribution-NonCommerical-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+  https://creativecommons.org/licenses/by-nc-sa/4.0/
+
+For published academic research using these tools, please cite:
+  Hollis, G. (2017). Scoring best/worst data in unbalanced, many-item designs,
+    with applications to crowdsourcing semantic judgments. Behavior Research
+    Methods, XX(X), 1-19. doi: 10.3758/s13428-017-0898-2
+"""
+import sys, os, argparse, json, struct, hashlib, tempfile, multiprocessing
+from array import array
+import numpy as np
+import scoring
+
+
+
+################################################################################
+# VARIABLES
+################################################################################
+
+# identifies a trial store, and the version of its layout
+MAGIC     = b"BWTRIAL1"
+
+# arrays in the file start on multiples of this many bytes
+ALIGNMENT = 64
+
+# where parsed files are cached, and how large the cache may grow, by default
+CACHE_DIR   = os.environ.get("BESTWORST_CACHE",
+                             os.path.join(os.path.expanduser("~"), ".cache", "bestworst_tools"))
+CACHE_BYTES = 1 << 30
+
+
+
+################################################################################
+# CLASSES
+################################################################################
+class TrialStore(object):
+    """Best-worst trials, encoded against a vocabulary of items. See the file
+       header for a description of each array.
+    """
+    def __init__(self, items, options, best, worst, participant=None,
+                 participants=None, group=None, groups=None):
+        self.items        = list(items)
+        self.options      = options
+        self.best         = best
+        self.worst        = worst
+        self.participant  = participant
+        self.participants = participants
+        self.group        = group
+        self.groups       = groups
+
+    def __len__(self):
+        return len(self.best)
+
+    ############################################################################
+    # READING AND WRITING
+    ############################################################################
+    @staticmethod
+    def from_files(files, bestCol="best", worstCol="worst", sep=None,
+                   idCol=None, groupCol=None):
+        """Builds a trial store from best-worst data in CSV or TSV files (see
+           scoring.iter_bestworst_rows). Participant ids are taken from idCol
+           if one is given, and are otherwise the name of each file. Group ids
+           are taken from groupCol, if one is given.
+        """
+        extraCols = tuple(col for col in (idCol, groupCol) if col != None)
+        items, participants, groups = { }, { }, { }
+        best, worst, participant, group = array('i'), array('i'), array('i'), array('i')
+        options, K = [ ], 0
+
+        def encode(vocab, label):
+            if label not in vocab:
+                vocab[label] = len(vocab)
+            return vocab[label]
+
+        for file in files:
+            rows = scoring.iter_bestworst_rows(file, bestCol=bestCol, worstCol=worstCol,
+                                               sep=sep, extraCols=extraCols)
+            opts = array('i')
+            for b, w, offered, extras in rows:
+                best.append(encode(items, b))
+                worst.append(encode(items, w))
+                offered = [ encode(items, item) for item in offered ]
+                K = max(K, len(offered))
+                opts.append(len(offered))
+                opts.extend(offered)
+                participant.append(encode(participants, extras[0] if idCol != None else file))
+                if groupCol != None:
+                    group.append(encode(groups, extras[-1]))
+            options.append(opts)
+
+        # lay options out as a padded matrix
+        matrix = np.full((len(best), K), -1, dtype=np.int32)
+        row    = 0
+        for opts in options:
+            j = 0
+            while j < len(opts):
+                n = opts[j]
+                matrix[row, :n] = opts[j+1:j+1+n]
+                row += 1
+                j   += n + 1
+
+        return TrialStore(items.keys(), matrix,
+                          np.array(best,  dtype=np.int32),
+                          np.array(worst, dtype=np.int32),
+                          np.array(participant, dtype=np.int32), list(participants.keys()),
+                          np.array(group, dtype=np.int32) if groupCol != None else None,
+                          list(groups.keys()) if groupCol != None else None)
+
+    def save(self, path):
+        """Writes the store to path.
+        """
+        arrays = [ ("options", self.options), ("best", self.best), ("worst", self.worst),
+                   ("participant", self.participant), ("group", self.group) ]
+        arrays = [ (name, np.ascontiguousarray(values, dtype=np.int32))
+                   for name, values in arrays if values is not None ]
+
+        # offsets are relative to the (aligned) end of the header
+        layout, offset = { }, 0
+        for name, values in arrays:
+            layout[name] = { "offset" : offset, "shape" : list(values.shape) }
+            offset += aligned(values.nbytes)
+        header = json.dumps({ "items"        : self.items,
+                              "participants" : self.participants,
+                              "groups"       : self.groups,
+                              "dtype"        : "<i4",
+                              "arrays"       : layout }).encode("utf-8")
+
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            f.write(b"\0" * (aligned(f.tell()) - f.tell()))
+            for name, values in arrays:
+                f.write(values.astype("<i4", copy=False).tobytes())
+                f.write(b"\0" * (aligned(values.nbytes) - values.nbytes))
+
+    @staticmethod
+    def load(path):
+        """Loads the store at path. Arrays are memory-mapped, read-only, rather
+           than read into memory.
+        """
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception("Not a best-worst trial store: %s" % path)
+            length, = struct.unpack("<Q", f.read(8))
+            header  = json.loads(f.read(length).decode("utf-8"))
+            start   = aligned(f.tell())
+
+        arrays = { }
+        for name, spec in header["arrays"].items():
+            shape = tuple(spec["shape"])
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=np.int32)
+            else:
+                arrays[name] = np.memmap(path, dtype=header["dtype"], mode="r",
+                                         offset=start + spec["offset"], shape=shape)
+        return TrialStore(header["items"], arrays["options"], arrays["best"], arrays["worst"],
+                          arrays.get("participant"), header["participants"],
+                          arrays.get("group"), header["groups"])
+
+    ############################################################################
+    # ACCESS
+    ############################################################################
+    def others(self):
+        """Returns a boolean mask over options, marking the items in each
+           trial that were neither chosen best nor worst. As in
+           scoring.iter_bestworst_data, only the first occurrence of the best
+           and worst item is excluded.
+        """
+        others = np.asarray(self.options) >= 0
+        for chosen in (self.best, self.worst):
+            match   = others & (np.asarray(self.options) == np.asarray(chosen)[:,None])
+            first   = match & (np.cumsum(match, axis=1) == 1)
+            others &= ~first
+        return others
+
+    def encoded(self, index=None):
+        """Returns the trials encoded as by scoring.encode_trials. Items are
+           numbered in the order of the store's vocabulary, continuing from
+           index if one is supplied.
+        """
+        if index is None:
+            index = { }
+        remap = np.array([ index.setdefault(item, len(index)) for item in self.items ], dtype=np.int32)
+        mask  = self.others()
+        return (index,
+                remap[np.asarray(self.best)],
+                remap[np.asarray(self.worst)],
+                remap[np.asarray(self.options)[mask]],
+                mask.sum(axis=1).astype(np.int32))
+
+    def iter_trials(self):
+        """Yields the trials as scoring.iter_bestworst_data would, as tuples of
+           (best, worst, (others)), in terms of item labels.
+        """
+        items = self.items
+        mask  = self.others()
+        for i in range(len(self)):
+            yield (items[self.best[i]], items[self.worst[i]],
+                   tuple(items[j] for j in np.asarray(self.options[i])[mask[i]]))
+
+    def participant_labels(self):
+        """Returns the participant label of every trial.
+        """
+        return [ self.participants[i] for i in self.participant ]
+
+
+
+class TrialCache(object):
+    """An on-disk cache of parsed best-worst data files, each kept as a trial
+       store. A file is looked up by its path, size, and modification time,
+       plus the columns and separator it was parsed with, so a changed file
+       (or a change of options) is simply a cache miss. Once the cache grows
+       past max_bytes, the least recently used entries are removed.
+    """
+    def __init__(self, path=None, max_bytes=CACHE_BYTES):
+        self.path      = path if path != None else CACHE_DIR
+        self.max_bytes = max_bytes
+
+    def key(self, file, bestCol="best", worstCol="worst", sep=None):
+        """Returns the name of the cache entry for file, parsed with the given
+           options.
+        """
+        stat = os.stat(file)
+        desc = json.dumps([ os.path.abspath(file), stat.st_size, stat.st_mtime_ns, bestCol, worstCol, sep ])
+        return hashlib.sha1(desc.encode("utf-8")).hexdigest() + ".bwt"
+
+    def load(self, file, bestCol="best", worstCol="worst", sep=None):
+        """Returns the trials in file as a TrialStore, from the cache if the
+           file is unchanged, and otherwise by parsing the file and caching
+           the result.
+        """
+        entry = os.path.join(self.path, self.key(file, bestCol=bestCol, worstCol=worstCol, sep=sep))
+        if os.path.exists(entry):
+            try:
+                store = TrialStore.load(entry)
+                os.utime(entry)     # mark as recently used
+                return store
+            except Exception:
+                pass                # unreadable entry; parse the file again
+
+        store = TrialStore.from_files([ file ], bestCol=bestCol, worstCol=worstCol, sep=sep)
+
+        # write under a temporary name first, so other processes reading the
+        # cache never see a partial entry
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        os.close(fd)
+        try:
+            store.save(tmp)
+            os.replace(tmp, entry)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return store
+        self.evict(keep=entry)
+        return store
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries until the cache fits in
+           max_bytes. The entry named by keep is never removed.
+        """
+        entries = [ ]
+        for name in os.listdir(self.path):
+            if not name.endswith(".bwt"):
+                continue
+            entry = os.path.join(self.path, name)
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue            # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, entry))
+
+        total = sum(size for mtime, size, entry in entries)
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Removes every entry from the cache.
+        """
+        max_bytes, self.max_bytes = self.max_bytes, -1
+        if os.path.isdir(self.path):
+            self.evict()
+        self.max_bytes = max_bytes
+
+
+
+################################################################################
+# SUPPORT FUNCTIONS
+################################################################################
+def aligned(n):
+    """Rounds n up to the next multiple of ALIGNMENT.
+    """
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def is_trial_store(path):
+    """True if the file at path is a trial store.
+    """
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+def iter_trials(file, bestCol="best", worstCol="worst", sep=None):
+    """Streams trials from file, which may be a trial store or best-worst data
+       in CSV or TSV, as tuples of (best, worst, (others)).
+    """
+    if is_trial_store(file):
+        return TrialStore.load(file).iter_trials()
+    return scoring.iter_bestworst_data(file, bestCol=bestCol, worstCol=worstCol, sep=sep)
+
+def encode_file(job):
+    """Encodes the trials in one file, which may be a trial store or best-worst
+       data in CSV or TSV, against a vocabulary of its own. job is a tuple of
+       (file, bestCol, worstCol, sep, cache), so that this can be mapped over
+       a process pool. cache may be None, or a TrialCache to read CSV data
+       through. Returns a tuple of (items, bests, worsts, others,
+       n_others), where items lists the file's vocabulary in index order, or
+       (None, message) if the file could not be read.
+    """
+    file, bestCol, worstCol, sep, cache = job
+    try:
+        if is_trial_store(file):
+            encoded = TrialStore.load(file).encoded()
+        elif cache != None:
+            encoded = cache.load(file, bestCol=bestCol, worstCol=worstCol, sep=sep).encoded()
+        else:
+            encoded = scoring.encode_trials(scoring.iter_bestworst_data(file, bestCol=bestCol,
+                                            worstCol=worstCol, sep=sep))
+    except Exception as e:
+        return (None, "%s: %s" % (type(e).__name__, str(e)))
+    return (list(encoded[0].keys()),) + tuple(np.ascontiguousarray(part) for part in encoded[1:])
+
+def load_encoded(files, bestCol="best", worstCol="worst", sep=None, processes=1, errors=None,
+                 cache=None):
+    """Reads trials from every file, each of which may be a trial store or
+       best-worst data in CSV or TSV, and returns them all encoded against one
+       vocabulary, as by scoring.encode_trials.
+
+       Each file is encoded against its own vocabulary, then remapped onto the
+       shared one, in the order files were given; items are therefore
+       numbered exactly as if every file had been read in turn. With
+       processes > 1 (or None, for one per CPU), files are encoded across a
+       pool of that many processes.
+
+       If errors is a list, files that cannot be read are skipped, and a
+       tuple of (file, message) is appended to errors for each. Otherwise,
+       the first unreadable file raises an exception.
+
+       If a cache is supplied (see TrialCache), CSV data is only parsed if it
+       has changed since it was last cached.
+    """
+    jobs = [ (file, bestCol, worstCol, sep, cache) for file in files ]
+    if processes == 1 or len(jobs) <= 1:
+        results = map(encode_file, jobs)
+        pool    = None
+    else:
+        # hand files out in chunks, so small files don't each cost a round trip
+        workers = processes or multiprocessing.cpu_count()
+        pool    = multiprocessing.Pool(workers)
+        results = pool.imap(encode_file, jobs, chunksize=max(1, min(64, len(jobs) // (4 * workers))))
+
+    try:
+        index, parts = { }, [ ]
+        for file, result in zip(files, results):
+            if result[0] is None:
+                if errors is None:
+                    raise Exception("Could not read %s: %s" % (file, result[1]))
+                errors.append((file, result[1]))
+                continue
+            items, bests, worsts, others, n_others = result
+            remap = np.array([ index.setdefault(item, len(index)) for item in items ], dtype=np.int32)
+            parts.append((remap[bests], remap[worsts], remap[others], n_others))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if len(parts) == 0:
+        return scoring.encode_trials([ ], index)
+    return (index,) + tuple(np.concatenate([ part[i] for part in parts ]).astype(np.int32)
+                            for i in range(4))
+
+
+
+################################################################################
+# MAIN
+################################################################################
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Tools for binary best-worst trial stores (.bwt).')
+    commands = parser.add_subparsers(dest="command")
+
+    convert = commands.add_parser("convert", help="Convert best-worst data in CSV or TSV files into a single trial store.")
+    convert.add_argument("input", nargs="+", type=str, help="Path to a file(s) containing data to convert.")
+    convert.add_argument("--out", type=str, required=True, help="Path to write the trial store to (e.g., trials.bwt).")
+    convert.add_argument("--sep", type=str, default=None, help="Specify the column separator. If None specified, use default (tab for .tsv, also when compressed as .tsv.gz etc., comma for all else)")
+    convert.add_argument("--best", type=str, default="best", help="Name of column that holds string of 'best' choice.")
+    convert.add_argument("--worst", type=str, default="worst", help="Name of column that holds string of 'worst' choice.")
+    convert.add_argument("--id_column", type=str, default=None, help="A column in your input data that specifies user ID. If no value is supplied, uses the name of the file.")
+    convert.add_argument("--group_column", type=str, default=None, help="An optional column in your input data that specifies a group for each trial.")
+
+    info = commands.add_parser("info", help="Summarize the contents of a trial store.")
+    info.add_argument("input", type=str, help="Path to a trial store.")
+
+    args = parser.parse_args(argv)
+    if args.command == "convert":
+        store = TrialStore.from_files(args.input, bestCol=args.best, worstCol=args.worst, sep=args.sep,
+                                      idCol=args.id_column, groupCol=args.group_column)
+        store.save(args.out)
+        sys.stderr.write("Wrote %d trials over %d items to %s\n" % (len(store), len(store.items), args.out))
+    elif args.command == "info":
+        store = TrialStore.load(args.input)
+        print("Trials,%d" % len(store))
+        print("Items,%d" % len(store.items))
+        print("K,%d" % store.options.shape[1])
+        print("Participants,%d" % len(store.participants))
+        if store.groups != None:
+            print("Groups,%d" % len(store.groups))
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,7 +14,9 @@ import streamlit as st
 import sys
 import os
 import io
+import itertools
 import tempfile
+import numpy as np
 from pathlib import Path
 
 # Add parent directory to path to import from bestworst_tools_python3
@@ -23,6 +25,7 @@ sys.path.insert(0, str(parent_dir))
 
 import trialgen
 import scoring
+import trialstore
 from spreadsheet import Spreadsheet
 
 # Page configuration
@@ -253,12 +256,36 @@ def create_trials_page():
         with col3:
             generator = st.selectbox(
                 "Generation method",
-                ["norepeateven", "even", "random", "norepeat"],
-                help="norepeateven = recommended (even distribution, no repeated pairs)"
+                ["norepeateven", "bibd", "even", "random", "norepeat", "adaptive"],
+                help="norepeateven = recommended (even distribution, no repeated pairs); "
+                     "bibd = constructs such a design exactly where possible, else uses norepeateven; "
+                     "adaptive = the next trials for an experiment under way, from the data collected so far"
             )
         
+        # groups of items that must never be shown together
+        exclude_file = st.file_uploader(
+            "Optional: items never to show together (.csv or .tsv)",
+            type=['csv', 'tsv', 'txt'],
+            help="One group per line, items separated by commas (tabs for .tsv), e.g. variants of the same word"
+        )
+        
+        # the adaptive generator works from the data collected so far
+        results_files = [ ]
+        if generator == "adaptive":
+            results_files = st.file_uploader(
+                "Upload the data collected so far (.csv, .tsv, optionally compressed, or .bwt trial stores)",
+                type=['csv', 'tsv', 'gz', 'bz2', 'xz', 'zst', 'bwt'],
+                accept_multiple_files=True,
+                help="New trials concentrate on items whose scores are still uncertain, and the items scored close to them"
+            )
+            col1, col2 = st.columns(2)
+            with col1:
+                best_col = st.text_input("Column name for 'best' choice", value="best")
+            with col2:
+                worst_col = st.text_input("Column name for 'worst' choice", value="worst")
+        
         # Validation
-        if (N * K) % len(items) != 0 and generator in ["norepeateven", "even"]:
+        if (N * K) % len(items) != 0 and generator in ["norepeateven", "bibd", "even"]:
             st.warning(f"⚠️ For even distribution: N × K must be divisible by {len(items)}. "
                       f"Current: {N} × {K} = {N*K} (not divisible by {len(items)})")
             st.info(f"💡 Suggested N values: {[len(items) * i for i in [4, 6, 8, 10, 12, 16]]}")
@@ -267,49 +294,118 @@ def create_trials_page():
         if st.button("🎲 Generate Trials", type="primary", use_container_width=True):
             try:
                 with st.spinner("Generating trials..."):
-                    # Generate trials
+                    # Generate trials a batch at a time, straight to a
+                    # temporary file, rather than holding them in memory
+                    stats   = { }
+                    exclude = None
+                    if exclude_file:
+                        suffix = Path(exclude_file.name).suffix or '.csv'
+                        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+                            tmp_file.write(exclude_file.getvalue())
+                            exclude_path = tmp_file.name
+                        try:
+                            exclude, unknown = trialgen.read_exclusions(exclude_path, items)
+                        finally:
+                            os.unlink(exclude_path)
+                        if len(unknown) > 0:
+                            st.info(f"ℹ️ Ignoring {len(unknown)} excluded items that are not in your items file.")
+                    
                     if generator == "norepeateven":
-                        trials = trialgen.build_trials_even_bigram_norepeat(items, N=N, K=K)
+                        batches = trialgen.iter_index_even_bigram_norepeat(len(items), N=N, K=K, stats=stats, exclude=exclude)
+                    elif generator == "bibd":
+                        batches = trialgen.iter_index_bibd(len(items), N=N, K=K, stats=stats, exclude=exclude)
                     elif generator == 'even':
-                        trials = trialgen.build_trials_even(items, N=N, K=K)
+                        batches = trialgen.iter_index_even(len(items), N=N, K=K, exclude=exclude)
                     elif generator == 'random':
-                        trials = trialgen.build_trials_random(items, N=N, K=K)
+                        batches = trialgen.iter_index_random(len(items), N=N, K=K, exclude=exclude)
                     elif generator == "norepeat":
-                        trials = trialgen.build_trials_random_bigram_norepeat(items, N=N, K=K)
-                    
-                    # Convert to CSV
-                    output = io.StringIO()
-                    header = [f"option{i+1}" for i in range(K)]
-                    output.write(",".join(header) + "\n")
-                    for trial in trials:
-                        output.write(",".join(trial) + "\n")
+                        batches = trialgen.iter_index_random_bigram_norepeat(len(items), N=N, K=K, time_limit=60, stats=stats,
+                                                                             exclude=exclude)
+                    elif generator == "adaptive":
+                        if not results_files:
+                            raise Exception("Upload the data collected so far to use the adaptive generator.")
+                        paths = [ ]
+                        try:
+                            for results_file in results_files:
+                                suffix = ''.join(Path(results_file.name).suffixes[-2:]) or '.csv'
+                                with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+                                    tmp_file.write(results_file.getvalue())
+                                    paths.append(tmp_file.name)
+                            encoded = trialstore.load_encoded(paths, bestCol=best_col, worstCol=worst_col)
+                        finally:
+                            for path in paths:
+                                os.unlink(path)
+                        table  = scoring.score_encoded(encoded, ["MaxDiffMNL"])
+                        scores, uncertainty = scoring.score_uncertainty(table, "MaxDiffMNL")
+                        labels = { str(entity) : i for i, entity in enumerate(table.entities) }
+                        known  = np.array([ labels.get(str(item), -1) for item in items ], dtype=np.int64)
+                        batches = trialgen.iter_index_adaptive(np.where(known >= 0, scores[known], np.nan),
+                                                               np.where(known >= 0, uncertainty[known], np.inf),
+                                                               N=N, K=K, stats=stats, exclude=exclude)
                     
-                    csv_data = output.getvalue()
+                    tally   = trialgen.DesignTally(len(items), K)
+                    batches = tally.track(batches)
+                    with tempfile.NamedTemporaryFile("w", delete=False, suffix='.csv', newline='') as tmp_file:
+                        written  = trialgen.write_trials(tmp_file, items, batches, K)
+                        tmp_path = tmp_file.name
+                    report = tally.evaluate()
                     
                     st.markdown('<div class="success-box">✅ <strong>Trials generated successfully!</strong></div>', 
                                unsafe_allow_html=True)
+                    if stats.get("construction", None) == "greedy":
+                        st.info("ℹ️ No cyclic design fits these settings; used norepeateven instead.")
+                    elif stats.get("construction", None) == "padded":
+                        st.info(f"ℹ️ No cyclic design fits these settings; built one with {stats['dummies']} dummy items and dropped their trials.")
+                    if stats.get("repeats", 0) > 0:
+                        st.info(f"ℹ️ Could not avoid {stats['repeats']} repeated pairs of items.")
+                    if stats.get("complete", True) == False and generator == "adaptive":
+                        st.warning(f"⚠️ Only {written} of {N} trials could be built without showing items too often.")
+                    elif stats.get("complete", True) == False:
+                        st.warning(f"⚠️ Only {written} of {N} trials could be built without repeating pairs.")
                     
                     col1, col2, col3 = st.columns(3)
                     with col1:
-                        st.metric("Trials Generated", len(trials))
+                        st.metric("Trials Generated", written)
                     with col2:
                         st.metric("Items per Trial", K)
                     with col3:
-                        st.metric("Total Presentations", len(trials) * K)
+                        st.metric("Total Presentations", written * K)
                     
-                    # Preview
-                    with st.expander("Preview first 10 trials"):
-                        preview_lines = csv_data.split('\n')[:11]
-                        st.code('\n'.join(preview_lines))
+                    # Design quality
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        st.metric("Appearances per Item", f"{report['appearances_min']}–{report['appearances_max']}")
+                    with col2:
+                        st.metric("Repeated Pairs", report["repeated_pairs"])
+                    with col3:
+                        st.metric("Connected", "Yes" if report["connected"] else f"No ({report['components']} parts)")
+                    if not report["connected"]:
+                        st.warning("⚠️ Some items are never compared, directly or indirectly, with others; "
+                                   "their scores cannot be placed on a common scale. Try more trials.")
+                    with st.expander("Design quality details"):
+                        st.table({ "Measure": [k for k in report if k != "pair_histogram"],
+                                   "Value": [str(report[k]) for k in report if k != "pair_histogram"] })
+                        st.table({ "Times seen together": list(report["pair_histogram"].keys()),
+                                   "Pairs of items": list(report["pair_histogram"].values()) })
                     
-                    # Download button
-                    st.download_button(
-                        label="📥 Download Trials CSV",
-                        data=csv_data,
-                        file_name=f"bestworst_trials_N{N}_K{K}.csv",
-                        mime="text/csv",
-                        use_container_width=True
-                    )
+                    try:
+                        # Preview
+                        with open(tmp_path, 'r') as f:
+                            preview_lines = [ line.rstrip('\n') for line in itertools.islice(f, 11) ]
+                        with st.expander("Preview first 10 trials"):
+                            st.code('\n'.join(preview_lines))
+                        
+                        # Download button
+                        with open(tmp_path, 'rb') as f:
+                            st.download_button(
+                                label="📥 Download Trials CSV",
+                                data=f,
+                                file_name=f"bestworst_trials_N{N}_K{K}.csv",
+                                mime="text/csv",
+                                use_container_width=True
+                            )
+                    finally:
+                        os.unlink(tmp_path)
                     
             except Exception as e:
                 st.error(f"❌ Error generating trials: {str(e)}")
@@ -339,16 +435,19 @@ def score_data_page():
         - **Value**: Tournament-based, robust to noise (recommended)
         - **Elo**: Chess-style rating system
         - **RW**: Rescorla-Wagner learning model
+        - **BT**: Bradley-Terry model fit, fast on large datasets
+        - **RankCentrality**: Random walk over the comparison graph, no shuffling randomness
+        - **MaxDiffMNL**: MaxDiff logit model fit to whole trials, with standard errors (MaxDiffMNLSE)
         - **Best/Worst/Unchosen**: Simple count-based methods
         - And more...
         """)
     
     # File upload
     uploaded_files = st.file_uploader(
-        "Upload participant data files (.csv or .tsv)",
-        type=['csv', 'tsv'],
+        "Upload participant data files (.csv, .tsv, optionally compressed, or .bwt trial stores)",
+        type=['csv', 'tsv', 'gz', 'bz2', 'xz', 'zst', 'bwt'],
         accept_multiple_files=True,
-        help="Upload one or more files with participant responses"
+        help="Upload one or more files with participant responses, or trial stores made with trialstore.py"
     )
     
     if uploaded_files:
@@ -367,7 +466,9 @@ def score_data_page():
         st.markdown("### 📊 Select Scoring Methods")
         
         all_methods = ["Value", "Elo", "RW", "Best", "Worst", "Unchosen", 
-                      "BestWorst", "ABW", "David", "ValueLogit", "RWLogit", "BestWorstLogit"]
+                      "BestWorst", "ABW", "David", "ValueLogit", "RWLogit", "BestWorstLogit",
+                      "BT", "BTLogit",
+                      "RankCentrality", "RankCentralityLogit", "MaxDiffMNL", "MaxDiffMNLSE"]
         
         col1, col2 = st.columns([3, 1])
         with col1:
@@ -392,12 +493,16 @@ def score_data_page():
                     # Save files temporarily and parse
                     trials = []
                     for uploaded_file in uploaded_files:
-                        with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as tmp_file:
+                        # keep e.g. .tsv.gz whole, so the reader sees both
+                        # the separator and the compression
+                        suffix = ''.join(Path(uploaded_file.name).suffixes[-2:]) or '.csv'
+                        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
                             tmp_file.write(uploaded_file.getvalue())
                             tmp_path = tmp_file.name
                         
                         try:
-                            file_trials = scoring.parse_bestworst_data(
+                            # CSV/TSV data, or a trial store made by trialstore.py
+                            file_trials = trialstore.iter_trials(
                                 tmp_path,
                                 bestCol=best_col,
                                 worstCol=worst_col
@@ -411,18 +516,16 @@ def score_data_page():
                         return
                     
                     # Calculate scores
-                    results = scoring.score_trials(trials, selected_methods)
+                    results = scoring.score_table(trials, selected_methods)
+                    scores = [results.scores(method).tolist() for method in selected_methods]
                     
                     # Convert to CSV
                     output = io.StringIO()
                     header = ["Item"] + selected_methods
                     output.write(",".join(header) + "\n")
                     
-                    for name, data in results.items():
-                        if type(name) != str:  # Skip dummy items
-                            continue
-                        scores = [scoring.scoring_methods[method](data) for method in selected_methods]
-                        row = [name] + [str(score) for score in scores]
+                    for i, name in enumerate(results.entities):
+                        row = [str(name)] + [str(score[i]) for score in scores]
                         output.write(",".join(row) + "\n")
                     
                     csv_data = output.getvalue()
@@ -434,7 +537,7 @@ def score_data_page():
                     with col1:
                         st.metric("Trials Processed", len(trials))
                     with col2:
-                        st.metric("Items Scored", len([k for k in results.keys() if type(k) == str]))
+                        st.metric("Items Scored", len(results))
                     with col3:
                         st.metric("Methods Used", len(selected_methods))
                     